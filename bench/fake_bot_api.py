@@ -0,0 +1,86 @@
+import json
+import asyncio
+from collections import Counter
+from itertools import count
+
+from telegram.request import BaseRequest
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'RoleBot', 'username': 'role_bot'}
+
+# Пользователь, от имени которого идут административные команды
+ADMIN_ID = 100
+
+
+# Поддельный Bot API: подставляется в ApplicationBuilder.request() вместо HTTP-клиента,
+# отвечает на запросы бота правдоподобными данными и считает вызовы по методам.
+# latency имитирует время ответа сервера Telegram.
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = count(1_000_000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': 0,
+                'chat': {'id': params.get('chat_id', 0), 'type': 'supergroup'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        if api_method == 'getChatAdministrators':
+            return [{'status': 'creator', 'is_anonymous': False,
+                     'user': {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'Admin'}}]
+        if api_method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': params.get('user_id'), 'is_bot': False, 'first_name': 'User'}}
+        return True
+
+
+# Генератор обновлений в формате Bot API
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+
+    def message(self, chat_id, user_id, text, username=None):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': username or f'user{user_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def callback(self, chat_id, user_id, data, message_id=1):
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'},
+                'message': {'message_id': message_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'supergroup'},
+                            'from': BOT_USER, 'text': '...'},
+            },
+        }
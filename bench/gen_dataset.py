@@ -0,0 +1,166 @@
+"""Генератор базы ролей заданного размера для замеров хранилища.
+
+Размеры чатов, ролей и популярность пользователей распределены по степенному закону:
+несколько чатов с тысячами ролей, роли на десятки тысяч участников и длинный хвост мелких.
+При одинаковом --seed получается одна и та же база:
+
+    python bench/gen_dataset.py /tmp/roles.db --chats 10000 --roles 100000 --memberships 1000000
+    python bench/gen_dataset.py /tmp/legacy.db --schema legacy
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+from bisect import bisect
+from itertools import accumulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from role_store import MIGRATIONS, RoleStore, member_key, role_key
+
+# Названия ролей; частые идут первыми. Кириллица проверяет ключ роли вне ASCII
+ROLE_NAMES = ['dev', 'qa', 'backend', 'frontend', 'devops', 'Разработка', 'design', 'pm', 'mobile',
+              'Поддержка', 'analytics', 'support', 'ios', 'android', 'data', 'Тестировщики', 'ml',
+              'security', 'sre', 'infra', 'Дизайн', 'marketing', 'sales', 'hr', 'Аналитика']
+
+
+# Накопленные веса 1/(i+1)^skew для выбора с помощью bisect
+def zipf_cumulative(n, skew):
+    return list(accumulate(1 / (i + 1) ** skew for i in range(n)))
+
+
+def pick(rng, cumulative):
+    return bisect(cumulative, rng.random() * cumulative[-1])
+
+
+class Dataset:
+    def __init__(self, chats, roles, memberships, users, skew, seed):
+        self.rng = random.Random(seed)
+        self.chats = chats
+        self.users = users
+        self.skew = skew
+        # [(chat_id, роль)] в порядке номеров роли
+        self.roles = self._roles(roles)
+        # [(номер роли, номер пользователя)] в порядке добавления
+        self.memberships = self._memberships(memberships)
+
+    # Пользователь: (user_id, username или None, имя); у каждого десятого нет username
+    @staticmethod
+    def user(number):
+        return number + 1, None if number % 10 == 9 else f'user{number}', f'User {number}'
+
+    def _roles(self, count):
+        rng = self.rng
+        chat_weights = zipf_cumulative(self.chats, self.skew)
+        name_weights = zipf_cumulative(len(ROLE_NAMES), self.skew)
+        # Каждый чат получает хотя бы одну роль, остальные достаются крупным чатам
+        owners = list(range(min(self.chats, count)))
+        owners += [pick(rng, chat_weights) for _ in range(count - len(owners))]
+        owners.sort()
+
+        roles = []
+        used = {}
+        for chat in owners:
+            keys = used.setdefault(chat, set())
+            name = ROLE_NAMES[pick(rng, name_weights)]
+            if rng.random() < 0.1:
+                name = name.capitalize()
+            # Повторы в чате различаются номером: dev, dev2, dev3...
+            candidate, number = name, 1
+            while role_key(candidate) in keys:
+                number += 1
+                candidate = f'{name}{number}'
+            keys.add(role_key(candidate))
+            roles.append((-1000000000000 - chat, candidate))
+        return roles
+
+    def _memberships(self, count):
+        rng = self.rng
+        # Популярность ролей не зависит от их номера, поэтому крупные роли рассыпаны по чатам
+        order = list(range(len(self.roles)))
+        rng.shuffle(order)
+        role_weights = zipf_cumulative(len(order), self.skew)
+        user_weights = zipf_cumulative(self.users, self.skew)
+
+        # Роль без участников бот удаляет, поэтому у каждой роли есть хотя бы один участник
+        roles = list(range(min(len(order), count)))
+        roles += [order[pick(rng, role_weights)] for _ in range(count - len(roles))]
+        rng.shuffle(roles)
+
+        members = {}
+        memberships = []
+        for role in roles:
+            taken = members.setdefault(role, set())
+            if len(taken) >= self.users:
+                continue
+            user = pick(rng, user_weights)
+            # Популярные пользователи быстро исчерпываются у крупной роли, дальше - равномерно
+            while user in taken:
+                user = rng.randrange(self.users)
+            taken.add(user)
+            memberships.append((role, user))
+        return memberships
+
+
+def write_current(path, dataset):
+    store = RoleStore(path)
+    store.init_db()
+    conn = store.conn
+    conn.set_trace_callback(None)
+    conn.execute('PRAGMA cache_size = -262144')
+    users = [dataset.user(number) for number in range(dataset.users)]
+    with store._write():
+        conn.executemany('INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)', users)
+        conn.executemany('INSERT INTO role_names (id, chat_id, role_key, role) VALUES (?, ?, ?, ?)',
+                         ((number + 1, chat_id, role_key(role), role)
+                          for number, (chat_id, role) in enumerate(dataset.roles)))
+        conn.executemany('INSERT INTO roles (chat_id, username, role, role_key, user_id) VALUES (?, ?, ?, ?, ?)',
+                         ((dataset.roles[number][0], member_key(*users[user][:2]), dataset.roles[number][1],
+                           role_key(dataset.roles[number][1]), users[user][0])
+                          for number, user in dataset.memberships))
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    store.close()
+
+
+# Схема первой версии бота: роли без чатов, регистр сравнивается через LOWER(role)
+def write_legacy(path, dataset):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA cache_size = -262144')
+    conn.execute('BEGIN')
+    MIGRATIONS[0](conn)
+    conn.execute('PRAGMA user_version = 1')
+    conn.executemany('INSERT OR IGNORE INTO roles (username, role) VALUES (?, ?)',
+                     ((f'user{user}', dataset.roles[number][1]) for number, user in dataset.memberships))
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a roles database with skewed distributions')
+    parser.add_argument('path', help='database file to create')
+    parser.add_argument('--chats', type=int, default=10000)
+    parser.add_argument('--roles', type=int, default=100000)
+    parser.add_argument('--memberships', type=int, default=1000000)
+    parser.add_argument('--users', type=int, help='distinct users, by default a fifth of --memberships')
+    parser.add_argument('--skew', type=float, default=1.0, help='power-law exponent of all distributions')
+    parser.add_argument('--schema', choices=('current', 'legacy'), default='current')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error(f'{args.path} already exists')
+    started = time.perf_counter()
+    dataset = Dataset(args.chats, args.roles, args.memberships, args.users or max(1, args.memberships // 5),
+                      args.skew, args.seed)
+    generated = time.perf_counter()
+    (write_legacy if args.schema == 'legacy' else write_current)(args.path, dataset)
+    print(f'{args.path}: {args.schema} schema, {args.chats} chats, {len(dataset.roles)} roles, '
+          f'{len(dataset.memberships)} memberships; generated in {generated - started:.1f} s, '
+          f'written in {time.perf_counter() - generated:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Нагрузочный прогон обработчиков бота без Telegram.
+
+Обновления подаются прямо в Application, а ответы Bot API подделывает FakeBotAPI.
+Каждый сценарий запускается в отдельном процессе с чистой временной базой:
+
+    python bench/run_bench.py mentions --updates 20000
+    python bench/run_bench.py setrole --updates 50 --usernames 300
+    python bench/run_bench.py roles --roles 5000
+    python bench/run_bench.py all --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ('mentions', 'setrole', 'roles')
+
+
+def configure_environment(directory):
+    # Настройки читаются при импорте модулей бота, поэтому задаются заранее
+    os.environ['ROLES_DB_URL'] = os.path.join(directory, 'roles.db')
+    os.environ['STATE_DB_PATH'] = os.path.join(directory, 'state.db')
+    os.environ['METRICS_PORT'] = '0'
+    # Очередь отправки не должна ограничивать скорость прогона
+    os.environ.setdefault('SEND_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('SEND_CHAT_RATE', '1000000')
+    os.environ.setdefault('SEND_CHAT_BURST', '1000000')
+    os.environ.setdefault('SEND_COALESCE_WINDOW', '0')
+    os.environ.setdefault('SEND_QUEUE_LIMIT', '1000000')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Болтовня в нескольких чатах, часть сообщений упоминает роли
+def mentions_scenario(store, factory, args, rng):
+    chats = args.chats or 20
+    roles = args.roles or 30
+    messages = args.updates or 20000
+    for chat in range(chats):
+        chat_id = -1000 - chat
+        for role in range(roles):
+            store.add_members(chat_id, f'role{role}', [f'member{role}_{i}' for i in range(10)])
+
+    words = ['привет', 'когда', 'релиз', 'посмотрите', 'пожалуйста', 'ок', 'спасибо', 'готово']
+    for _ in range(messages):
+        chat_id = -1000 - rng.randrange(chats)
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+        if rng.random() < 0.3:
+            text = f'@role{rng.randrange(roles)} {text}'
+        elif rng.random() < 0.2:
+            text = f'@someone {text}'
+        yield 'mention', factory.message(chat_id, rng.randint(1000, 5000), text)
+
+
+# Назначение роли сотням пользователей через диалог /setrole
+def setrole_scenario(store, factory, args, rng):
+    from fake_bot_api import ADMIN_ID
+    dialogs = args.updates or 50
+    usernames = args.usernames or 300
+    chat_id = -2000
+    for dialog in range(dialogs):
+        yield 'setrole', factory.message(chat_id, ADMIN_ID, '/setrole')
+        yield 'option', factory.callback(chat_id, ADMIN_ID, 'sr:n')
+        yield 'role_name', factory.message(chat_id, ADMIN_ID, f'team{dialog}')
+        names = ' '.join(f'@user{rng.randrange(100000)}' for _ in range(usernames))
+        yield 'usernames', factory.message(chat_id, ADMIN_ID, names)
+
+
+# /roles и листание страниц в чате с тысячами ролей
+def roles_scenario(store, factory, args, rng):
+    roles = args.roles or 5000
+    requests = args.updates or 200
+    chat_id = -3000
+    for role in range(roles):
+        store.add_members(chat_id, f'role{role:05d}', [f'member{role}_{i}' for i in range(3)])
+
+    for _ in range(requests):
+        if rng.random() < 0.5:
+            yield 'roles', factory.message(chat_id, rng.randint(1000, 5000), '/roles')
+        else:
+            yield 'page', factory.callback(chat_id, rng.randint(1000, 5000), f'rl:p:{rng.randrange(roles) // 20 * 20}')
+
+
+async def run_scenario(name, args):
+    from telegram import Update
+    from telegram.ext import Application
+
+    import roledistributor
+    from role_store import sql_statements
+    from fake_bot_api import FakeBotAPI, UpdateFactory
+
+    api = FakeBotAPI(latency=args.api_latency)
+    application = roledistributor.build_application(
+        Application.builder().token('1:bench').request(api).get_updates_request(FakeBotAPI())
+    )
+
+    # База заполняется до запуска, чтобы индекс ролей загрузился так же, как в проде
+    backend = roledistributor.store.store
+    backend.init_db()
+    scenario = {'mentions': mentions_scenario, 'setrole': setrole_scenario, 'roles': roles_scenario}[name]
+    updates = list(scenario(backend, UpdateFactory(), args, random.Random(args.seed)))
+    backend.close()
+
+    latencies = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(label, data):
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies.setdefault(label, []).append(time.perf_counter() - start)
+
+    async with application:
+        await roledistributor.post_init(application)
+        await application.start()
+
+        sql_before = sum(sql_statements.collect().values())
+        api.calls.clear()
+        start = time.perf_counter()
+        if args.concurrency == 1:
+            for label, data in updates:
+                await process(label, data)
+        else:
+            await asyncio.gather(*(process(label, data) for label, data in updates))
+        elapsed = time.perf_counter() - start
+        sql_count = sum(sql_statements.collect().values()) - sql_before
+
+        # Ответы уходят из очереди отправки в фоне; ждём, пока она опустеет
+        drain_start = time.perf_counter()
+        while roledistributor.send_queue.pending_count() and time.perf_counter() - drain_start < 60:
+            await asyncio.sleep(0.01)
+        drain = time.perf_counter() - drain_start
+
+        await application.stop()
+        await roledistributor.post_stop(application)
+
+    everything = [value for values in latencies.values() for value in values]
+    return {
+        'scenario': name,
+        'updates': len(updates),
+        'seconds': round(elapsed, 3),
+        'send_queue_drain_seconds': round(drain, 3),
+        'updates_per_second': round(len(updates) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(everything, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(everything, 0.99) * 1000, 3),
+        'sql_statements': sql_count,
+        'sql_per_update': round(sql_count / len(updates), 2) if updates else 0,
+        'api_calls': dict(api.calls),
+        'steps': {
+            label: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            }
+            for label, values in latencies.items()
+        },
+    }
+
+
+def print_report(result):
+    print(f"{result['scenario']}: {result['updates']} updates in {result['seconds']} s, "
+          f"{result['updates_per_second']} updates/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+          f"{result['sql_statements']} SQL statements ({result['sql_per_update']} per update)")
+    for label, step in result['steps'].items():
+        print(f"  {label:<12} {step['count']:>7}  p50 {step['p50_ms']:>9} ms  p99 {step['p99_ms']:>9} ms")
+    print(f"  send queue drained in {result['send_queue_drain_seconds']} s")
+    calls = ', '.join(f'{method} {number}' for method, number in sorted(result['api_calls'].items()))
+    print(f"  Bot API: {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot handlers against a fake Bot API')
+    parser.add_argument('scenario', choices=SCENARIOS + ('all',))
+    parser.add_argument('--updates', type=int, help='number of updates (dialogs for setrole)')
+    parser.add_argument('--chats', type=int, help='number of chats in the mentions scenario')
+    parser.add_argument('--roles', type=int, help='roles per chat (mentions) or in the chat (roles)')
+    parser.add_argument('--usernames', type=int, help='usernames per /setrole in the setrole scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='updates processed at the same time')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated Bot API latency, seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    args = parser.parse_args()
+
+    if args.scenario == 'all':
+        # Каждый сценарий - в своём процессе, чтобы состояние модулей бота не пересекалось
+        passthrough = [arg for arg in sys.argv[2:]]
+        for scenario in SCENARIOS:
+            subprocess.run([sys.executable, os.path.abspath(__file__), scenario] + passthrough, check=True)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure_environment(directory)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        # Логи обработчиков искажают замеры
+        import logging
+        logging.disable(logging.WARNING)
+        result = asyncio.run(run_scenario(args.scenario, args))
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
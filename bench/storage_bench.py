@@ -0,0 +1,232 @@
+"""Замеры SQL-выражений хранилища ролей на базе из gen_dataset.py.
+
+Для каждого выражения, которое выполняет бот, печатаются время (p50/p99/среднее),
+число строк в ответе и EXPLAIN QUERY PLAN. Схема определяется по PRAGMA user_version:
+для базы первой версии (--schema legacy) замеряются выражения старого бота - поиск по LOWER(role),
+GROUP BY role, DISTINCT role и запись по одному пользователю.
+
+    python bench/storage_bench.py /tmp/roles.db
+    python bench/storage_bench.py /tmp/legacy.db --iterations 50 --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from role_store import PRAGMAS, SCHEMA_VERSION, role_key
+from run_bench import percentile
+
+# Режимы выполнения: read - просто запрос; commit - отдельная транзакция с фиксацией,
+# как запись одного пользователя в боте; rollback - разрушающее выражение, которое откатывается
+READ, COMMIT, ROLLBACK = 'read', 'commit', 'rollback'
+
+
+class Statement:
+    def __init__(self, name, sql, params, mode=READ, scan=False):
+        self.name = name
+        self.sql = sql
+        # params(образец, номер итерации) -> параметры выражения
+        self.params = params
+        self.mode = mode
+        # Полный проход по таблице: выполняется --scan-iterations раз
+        self.scan = scan
+
+
+# Выражения текущего хранилища (role_store.RoleStore);
+# образец - (chat_id, номер роли, роль, ключ участника, ролей в чате, user_id)
+CURRENT = (
+    Statement('all_memberships', 'SELECT chat_id, username, role_key FROM roles ORDER BY rowid',
+              lambda s, i: (), scan=True),
+    Statement('list_roles', 'SELECT id, role FROM role_names WHERE chat_id = ? ORDER BY role_key',
+              lambda s, i: (s[0],)),
+    Statement('role_name', 'SELECT role FROM role_names WHERE id = ? AND chat_id = ?',
+              lambda s, i: (s[1], s[0])),
+    Statement('count_roles', 'SELECT COUNT(*) FROM role_names WHERE chat_id = ?',
+              lambda s, i: (s[0],)),
+    Statement('roles_page', '''SELECT roles.role_key, roles.role, roles.username FROM roles
+                               JOIN (SELECT role_key FROM role_names WHERE chat_id = ?
+                                     ORDER BY role_key LIMIT ? OFFSET ?) AS page
+                               ON roles.role_key = page.role_key
+                               WHERE roles.chat_id = ?
+                               ORDER BY roles.role_key, roles.rowid''',
+              lambda s, i: (s[0], 20, (i * 20) % max(s[4], 1) // 20 * 20, s[0])),
+    Statement('roles_all', '''SELECT roles.role_key, roles.role, roles.username FROM roles
+                              JOIN (SELECT role_key FROM role_names WHERE chat_id = ?
+                                    ORDER BY role_key LIMIT ? OFFSET ?) AS page
+                              ON roles.role_key = page.role_key
+                              WHERE roles.chat_id = ?
+                              ORDER BY roles.role_key, roles.rowid''',
+              lambda s, i: (s[0], -1, 0, s[0])),
+    Statement('role_members', 'SELECT username FROM roles WHERE chat_id = ? AND role_key = ?',
+              lambda s, i: (s[0], role_key(s[2]))),
+    Statement('user_roles', 'SELECT role FROM roles WHERE chat_id = ? AND username = ?',
+              lambda s, i: (s[0], s[3])),
+    Statement('register_role_lookup', 'SELECT role FROM role_names WHERE chat_id = ? AND role_key = ?',
+              lambda s, i: (s[0], role_key(s[2]))),
+    Statement('member_exists', 'SELECT 1 FROM roles WHERE chat_id = ? AND role_key = ? AND username = ?',
+              lambda s, i: (s[0], role_key(s[2]), s[3])),
+    Statement('register_role', 'INSERT OR IGNORE INTO role_names (chat_id, role_key, role) VALUES (?, ?, ?)',
+              lambda s, i: (s[0], role_key(s[2]), s[2]), COMMIT),
+    # Новые участники добавляются и затем удаляются тем же набором параметров
+    Statement('add_member', '''INSERT OR IGNORE INTO roles (chat_id, username, role, role_key, user_id)
+                               VALUES (?, ?, ?, ?, COALESCE((SELECT user_id FROM users WHERE username = ?), ?))''',
+              lambda s, i: (s[0], f'bench{i}', s[2], role_key(s[2]), f'bench{i}', None), COMMIT),
+    Statement('remove_member', 'DELETE FROM roles WHERE chat_id = ? AND role_key = ? AND username = ?',
+              lambda s, i: (s[0], role_key(s[2]), f'bench{i}'), COMMIT),
+    Statement('drop_role_if_empty', '''DELETE FROM role_names WHERE chat_id = ? AND role_key = ?
+                                       AND NOT EXISTS (SELECT 1 FROM roles WHERE chat_id = ? AND role_key = ?)''',
+              lambda s, i: (s[0], role_key(s[2]), s[0], role_key(s[2])), COMMIT),
+    Statement('remove_role', 'DELETE FROM roles WHERE chat_id = ? AND role_key = ?',
+              lambda s, i: (s[0], role_key(s[2])), ROLLBACK),
+    # Запись пользователей из обновлений (upsert_users) для уже известного пользователя
+    Statement('all_users', 'SELECT user_id, username, first_name FROM users', lambda s, i: (), scan=True),
+    Statement('username_owner', 'SELECT user_id FROM users WHERE username = ? AND user_id != ?',
+              lambda s, i: (s[3], s[5] or 0)),
+    Statement('upsert_user', '''INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+                                ON CONFLICT (user_id) DO UPDATE
+                                SET username = excluded.username, first_name = excluded.first_name''',
+              lambda s, i: (s[5] or -1 - i, None if s[3].startswith('#') else s[3], 'Bench'), ROLLBACK),
+    Statement('link_members', 'UPDATE roles SET user_id = ? WHERE username = ? AND user_id IS NULL',
+              lambda s, i: (s[5] or 0, s[3]), ROLLBACK),
+    Statement('member_rekey_lookup', '''SELECT rowid, chat_id, role_key, username FROM roles
+                                        WHERE user_id = ? AND username != ?''',
+              lambda s, i: (s[5] or 0, s[3])),
+)
+
+# Выражения первой версии бота; образец - (роль, username)
+LEGACY = (
+    Statement('mention_lower_role', 'SELECT DISTINCT username FROM roles WHERE LOWER(role) = ?',
+              lambda s, i: (s[0].lower(),)),
+    Statement('roles_group_by', 'SELECT role FROM roles GROUP BY role', lambda s, i: (), scan=True),
+    Statement('roles_distinct', 'SELECT DISTINCT role FROM roles', lambda s, i: (), scan=True),
+    Statement('role_members', 'SELECT username FROM roles WHERE role = ?', lambda s, i: (s[0],)),
+    Statement('role_members_distinct', 'SELECT DISTINCT username FROM roles WHERE role = ?',
+              lambda s, i: (s[0],)),
+    Statement('user_roles', 'SELECT role FROM roles WHERE username = ?', lambda s, i: (s[1],)),
+    Statement('add_member', 'INSERT OR IGNORE INTO roles (username, role) VALUES (?, ?)',
+              lambda s, i: (f'bench{i}', s[0]), COMMIT),
+    Statement('remove_member', 'DELETE FROM roles WHERE username = ? AND role = ?',
+              lambda s, i: (f'bench{i}', s[0]), COMMIT),
+    Statement('remove_role', 'DELETE FROM roles WHERE role = ?', lambda s, i: (s[0],), ROLLBACK),
+)
+
+
+def connect(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    conn.create_function('role_key', 1, role_key, deterministic=True)
+    return conn
+
+
+# Образцы параметров - случайные назначения ролей, так что крупные роли и чаты попадаются чаще
+def samples(conn, schema, count, rng):
+    last = conn.execute('SELECT MAX(rowid) FROM roles').fetchone()[0] or 0
+    result = []
+    while last and len(result) < count:
+        rowid = rng.randint(1, last)
+        if schema == 'legacy':
+            row = conn.execute('SELECT role, username FROM roles WHERE rowid = ?', (rowid,)).fetchone()
+        else:
+            row = conn.execute('''SELECT roles.chat_id, role_names.id, roles.role, roles.username,
+                                         (SELECT COUNT(*) FROM role_names AS chat WHERE chat.chat_id = roles.chat_id),
+                                         roles.user_id
+                                  FROM roles JOIN role_names
+                                  ON role_names.chat_id = roles.chat_id AND role_names.role_key = roles.role_key
+                                  WHERE roles.rowid = ?''', (rowid,)).fetchone()
+        if row:
+            result.append(row)
+    return result
+
+
+# EXPLAIN QUERY PLAN в виде дерева с отступами
+def query_plan(conn, statement, params):
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in conn.execute('EXPLAIN QUERY PLAN ' + statement.sql, params):
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node] + detail)
+    return lines
+
+
+def measure(conn, statement, sample_rows, iterations):
+    timings = []
+    rows = 0
+    for i in range(iterations):
+        params = statement.params(sample_rows[i % len(sample_rows)], i)
+        start = time.perf_counter()
+        if statement.mode == READ:
+            rows += len(conn.execute(statement.sql, params).fetchall())
+        else:
+            conn.execute('BEGIN IMMEDIATE')
+            rows += conn.execute(statement.sql, params).rowcount
+            conn.execute('COMMIT' if statement.mode == COMMIT else 'ROLLBACK')
+        timings.append(time.perf_counter() - start)
+    return {
+        'name': statement.name,
+        'mode': statement.mode,
+        'iterations': iterations,
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'rows': round(rows / iterations, 1),
+        'plan': query_plan(conn, statement, statement.params(sample_rows[0], 0)),
+    }
+
+
+def print_report(result):
+    print(f"{result['path']}: {result['schema']} schema, {result['memberships']} memberships")
+    for item in result['statements']:
+        print(f"\n{item['name']} ({item['mode']}, {item['iterations']} runs): p50 {item['p50_ms']} ms, "
+              f"p99 {item['p99_ms']} ms, mean {item['mean_ms']} ms, {item['rows']} rows")
+        for line in item['plan']:
+            print(f'    {line}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time roles.db statements and show their query plans')
+    parser.add_argument('path', help='database created by gen_dataset.py')
+    parser.add_argument('--iterations', type=int, default=200, help='runs of each indexed statement')
+    parser.add_argument('--scan-iterations', type=int, default=3, help='runs of each full-table statement')
+    parser.add_argument('--only', action='append', help='run only the named statement, may be repeated')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.error(f'{args.path} does not exist, create it with bench/gen_dataset.py')
+    conn = connect(args.path)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (1, SCHEMA_VERSION):
+        parser.error(f'{args.path} has schema version {version}, expected 1 (legacy) or {SCHEMA_VERSION}')
+    schema = 'legacy' if version == 1 else 'current'
+
+    sample_rows = samples(conn, schema, args.iterations, random.Random(args.seed))
+    if not sample_rows:
+        parser.error(f'{args.path} has no roles')
+    statements = [statement for statement in (LEGACY if schema == 'legacy' else CURRENT)
+                  if not args.only or statement.name in args.only]
+    result = {
+        'path': args.path,
+        'schema': schema,
+        'memberships': conn.execute('SELECT COUNT(*) FROM roles').fetchone()[0],
+        'statements': [measure(conn, statement, sample_rows,
+                               args.scan_iterations if statement.scan else args.iterations)
+                       for statement in statements],
+    }
+    conn.close()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import logging
+import time
+
+from telegram.error import RetryAfter, TelegramError
+
+from metrics import Counter
+
+# Сколько секунд копить удаления перед отправкой пачки
+DELETE_BATCH_DELAY = float(os.getenv('DELETE_BATCH_DELAY', '0.5'))
+# Минимальный интервал между запросами на удаление в одном чате
+DELETE_CHAT_INTERVAL = float(os.getenv('DELETE_CHAT_INTERVAL', '1.0'))
+# deleteMessages принимает не больше 100 сообщений за раз
+MAX_BATCH_SIZE = 100
+
+deleted_messages = Counter(
+    'roledistributor_deleted_messages_total',
+    'Сообщения, отправленные на удаление',
+)
+deletion_requests = Counter(
+    'roledistributor_deletion_requests_total',
+    'Запросы к Bot API на удаление сообщений',
+    ('method',),
+)
+deletion_failures = Counter(
+    'roledistributor_deletion_failures_total',
+    'Неудачные запросы на удаление сообщений',
+    ('reason',),
+)
+
+
+# Фоновая очередь удаления служебных сообщений.
+# Обработчики только ставят сообщение в очередь и сразу отвечают пользователю,
+# а фоновая задача раз в DELETE_BATCH_DELAY собирает накопленное по чатам
+# и удаляет одним вызовом deleteMessages, соблюдая интервал между запросами в чат.
+class DeletionQueue:
+    def __init__(self, batch_delay=DELETE_BATCH_DELAY, chat_interval=DELETE_CHAT_INTERVAL):
+        self.batch_delay = batch_delay
+        self.chat_interval = chat_interval
+        # chat_id -> {message_id: None}, словарь сохраняет порядок постановки
+        self._pending = {}
+        # chat_id -> время (monotonic), раньше которого в чат не обращаемся
+        self._not_before = {}
+        self._wakeup = None
+        self._bot = None
+        self._task = None
+
+    # Запускает фоновую задачу; вызывается из работающего цикла событий
+    def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        if self._pending:
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    # Останавливает задачу и удаляет всё, что осталось в очереди
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._bot is not None:
+            batches, _ = self._take(ignore_interval=True)
+            await asyncio.gather(*(self._send(chat_id, message_ids) for chat_id, message_ids in batches))
+
+    def delete(self, chat_id, message_id):
+        if chat_id is None or message_id is None:
+            return
+        self._pending.setdefault(chat_id, {})[message_id] = None
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending_count(self):
+        return sum(len(ids) for ids in self._pending.values())
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Даём обработчику дослать соседние удаления, чтобы они ушли одной пачкой
+            await asyncio.sleep(self.batch_delay)
+            self._wakeup.clear()
+            batches, wait = self._take()
+            # Разные чаты не ждут друг друга
+            await asyncio.gather(*(self._send(chat_id, message_ids) for chat_id, message_ids in batches))
+            if self._pending:
+                if not batches and wait is not None:
+                    await asyncio.sleep(wait)
+                self._wakeup.set()
+
+    # Забирает из очереди пачки для чатов, в которые уже можно обращаться.
+    # Возвращает ([(chat_id, [message_id, ...])], сколько ждать до следующего чата)
+    def _take(self, ignore_interval=False):
+        now = time.monotonic()
+        batches = []
+        wait = None
+        for chat_id in list(self._pending):
+            not_before = self._not_before.get(chat_id, 0)
+            if not ignore_interval and not_before > now:
+                delay = not_before - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            message_ids = list(self._pending.pop(chat_id))
+            for i in range(0, len(message_ids), MAX_BATCH_SIZE):
+                batches.append((chat_id, message_ids[i:i + MAX_BATCH_SIZE]))
+            self._not_before[chat_id] = now + self.chat_interval
+        return batches, wait
+
+    async def _send(self, chat_id, message_ids):
+        deleted_messages.inc(len(message_ids))
+        try:
+            if len(message_ids) == 1:
+                deletion_requests.inc(method='deleteMessage')
+                await self._bot.delete_message(chat_id=chat_id, message_id=message_ids[0])
+            else:
+                deletion_requests.inc(method='deleteMessages')
+                await self._bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        except RetryAfter as e:
+            # Telegram просит подождать: возвращаем сообщения в очередь и не трогаем чат retry_after секунд
+            deletion_failures.inc(reason='RetryAfter')
+            pending = self._pending.setdefault(chat_id, {})
+            for message_id in message_ids:
+                pending[message_id] = None
+            self._not_before[chat_id] = time.monotonic() + e.retry_after
+            self._wakeup.set()
+        except TelegramError as e:
+            # Сообщение уже удалено, слишком старое или у бота нет прав - повторять бессмысленно
+            deletion_failures.inc(reason=type(e).__name__)
+            logging.debug(f"Could not delete messages {message_ids} in chat {chat_id}: {e}")
+        except Exception:
+            deletion_failures.inc(reason='error')
+            logging.exception(f"Error deleting messages in chat {chat_id}")
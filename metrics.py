@@ -0,0 +1,203 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Адрес и порт HTTP-сервера с метриками; порт 0 отключает сервер
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+METRICS_PATH = '/metrics'
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все созданные метрики процесса
+REGISTRY = []
+
+
+# Счётчик с необязательными метками, например: deletions_failed.inc(reason='BadRequest')
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    # Текущие значения: {(значения меток): значение}
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+# Текущее значение, которое может и расти, и уменьшаться, например число живых диалогов
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    # Значения вычисляются при каждом сборе метрик: func() возвращает {(значения меток): значение}
+    def set_function(self, func):
+        self._function = func
+
+    def collect(self):
+        if self._function is not None:
+            return dict(self._function())
+        return super().collect()
+
+
+# Гистограмма длительностей: число наблюдений по корзинам, сумма и количество
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # {(значения меток): (накопительные счётчики по корзинам, сумма, количество)}
+    def collect(self):
+        with self._lock:
+            result = {}
+            for key, (counts, total, count) in self._values.items():
+                cumulative = []
+                running = 0
+                for bucket_count in counts:
+                    running += bucket_count
+                    cumulative.append(running)
+                result[key] = (cumulative, total, count)
+            return result
+
+
+handler_updates = Counter(
+    'roledistributor_handler_updates_total',
+    'Обновления, обработанные обработчиком',
+    ('handler', 'status'),
+)
+handler_latency = Histogram(
+    'roledistributor_handler_latency_seconds',
+    'Время работы обработчика',
+    ('handler',),
+)
+
+
+# Считает вызовы и время работы асинхронного обработчика под его именем
+def instrument(func):
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            handler_updates.inc(handler=name, status=status)
+            handler_latency.observe(time.perf_counter() - start, handler=name)
+    return wrapper
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# Все метрики в текстовом формате Prometheus
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for key, value in sorted(metric.collect().items()):
+            if metric.type != 'histogram':
+                lines.append(f'{metric.name}{_labels(metric.labelnames, key)} {value}')
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(metric.buckets, counts):
+                lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, key, [("le", bound)])} {bucket_count}')
+            lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{metric.name}_sum{_labels(metric.labelnames, key)} {total}')
+            lines.append(f'{metric.name}_count{_labels(metric.labelnames, key)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != METRICS_PATH:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+# Запускает HTTP-сервер с /metrics в фоновом потоке; порт 0 - сервер не нужен
+def start_http_server(port=METRICS_PORT, listen=METRICS_LISTEN):
+    if not port:
+        return None
+    httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f"Serving metrics on http://{listen}:{port}{METRICS_PATH}")
+    return httpd
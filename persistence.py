@@ -0,0 +1,176 @@
+import os
+import json
+import logging
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from role_store import BUSY_TIMEOUT_MS, retry_on_locked
+
+# Файл с состоянием диалогов и user_data; отдельно от ролей, чтобы не мешать их записи
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'db/state.db')
+# Как часто приложение передаёт изменённое состояние в хранилище, секунды
+STATE_UPDATE_INTERVAL = float(os.getenv('STATE_UPDATE_INTERVAL', '5'))
+# Сколько секунд копить изменения перед записью одной транзакцией
+STATE_FLUSH_DELAY = float(os.getenv('STATE_FLUSH_DELAY', '1'))
+
+# Файл состояния рабочего процесса вебхука: у каждого процесса свои чаты, а значит и свои диалоги
+def worker_state_path(index, path=STATE_DB_PATH):
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index}{ext}'
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS conversations
+    (name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_data
+    (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+'''
+
+
+# Хранилище состояния диалогов (ConversationHandler) и context.user_data в SQLite.
+# Состояние держится в памяти, а изменения копятся и раз в STATE_FLUSH_DELAY
+# записываются одной транзакцией в отдельном потоке, так что обработка обновлений их не ждёт.
+# Значения хранятся в JSON: в user_data лежат только строки, числа, списки и словари.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path=STATE_DB_PATH, update_interval=STATE_UPDATE_INTERVAL, flush_delay=STATE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.flush_delay = flush_delay
+        # Все обращения к базе идут через один поток и одно соединение
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-store')
+        self._conn = None
+        # Несохранённые изменения: ключ -> JSON или None для удаления
+        self._dirty_users = {}
+        self._dirty_conversations = {}
+        self._flush_task = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _load_user_data(self):
+        rows = self._connect().execute('SELECT user_id, data FROM user_data')
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def _load_conversations(self, name):
+        rows = self._connect().execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    @retry_on_locked
+    def _write(self, users, conversations):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                             [(user_id, data) for user_id, data in users.items() if data is not None])
+            conn.executemany('DELETE FROM user_data WHERE user_id = ?',
+                             [(user_id,) for user_id, data in users.items() if data is None])
+            conn.executemany('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                             [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+            conn.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                             [(name, key) for (name, key), state in conversations.items() if state is None])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # Записывает накопленные изменения одной транзакцией
+    async def _flush_dirty(self):
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not conversations:
+            return
+        try:
+            await self._run(self._write, users, conversations)
+        except Exception:
+            logging.exception(f"Failed to save state of {len(users)} users and {len(conversations)} conversations, "
+                              "will retry")
+            # Более свежие изменения тех же ключей важнее
+            self._dirty_users = {**users, **self._dirty_users}
+            self._dirty_conversations = {**conversations, **self._dirty_conversations}
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._flush_dirty()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def get_user_data(self):
+        return await self._run(self._load_user_data)
+
+    async def update_user_data(self, user_id, data):
+        self._dirty_users[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        state = json.dumps(new_state) if new_state is not None else None
+        self._dirty_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._flush_dirty()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    # chat_data, bot_data и callback_data бот не использует
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
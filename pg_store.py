@@ -0,0 +1,311 @@
+import os
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+from role_store import BaseRoleStore, count_statement, member_key, member_user_id, role_key
+
+# Повторные попытки транзакции при конфликте или потере соединения
+WRITE_RETRIES = int(os.getenv('ROLES_DB_WRITE_RETRIES', '5'))
+RETRY_BACKOFF_SECONDS = float(os.getenv('ROLES_DB_RETRY_BACKOFF', '0.05'))
+
+# Ключ advisory-блокировки, под которой рабочие процессы по очереди обновляют схему
+MIGRATION_LOCK_ID = 0x726f6c6573
+
+_INSERT_MEMBER = '''INSERT INTO roles (chat_id, username, role, role_key, user_id) VALUES %s
+                    ON CONFLICT (chat_id, role_key, username) DO NOTHING'''
+# user_id участника берётся из таблицы пользователей, а для пользователя без username - из его ключа
+_MEMBER_TEMPLATE = '(%s, %s, %s, %s, COALESCE((SELECT user_id FROM users WHERE username = %s), %s))'
+
+
+# Миграции схемы PostgreSQL. Номер применённой миграции хранится в таблице schema_version.
+# id в roles задаёт порядок добавления, как rowid в SQLite.
+MIGRATIONS = (
+    (
+        '''CREATE TABLE roles
+           (id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            username TEXT NOT NULL,
+            role TEXT NOT NULL,
+            role_key TEXT NOT NULL)''',
+        '''CREATE UNIQUE INDEX idx_roles_chat_role_key_username
+           ON roles (chat_id, role_key, username)''',
+        '''CREATE INDEX idx_roles_chat_username
+           ON roles (chat_id, username, role)''',
+        '''CREATE TABLE role_names
+           (id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            role_key TEXT NOT NULL,
+            role TEXT NOT NULL)''',
+        '''CREATE UNIQUE INDEX idx_role_names_chat_role_key
+           ON role_names (chat_id, role_key)''',
+    ),
+    (
+        '''CREATE TABLE chat_settings
+           (chat_id BIGINT PRIMARY KEY,
+            mention_cooldown DOUBLE PRECISION)''',
+    ),
+    (
+        '''CREATE TABLE users
+           (user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT NOT NULL)''',
+        '''CREATE UNIQUE INDEX idx_users_username
+           ON users (username)''',
+        '''ALTER TABLE roles ADD COLUMN user_id BIGINT''',
+        '''CREATE INDEX idx_roles_user_id
+           ON roles (user_id) WHERE user_id IS NOT NULL''',
+        '''CREATE INDEX idx_roles_unlinked
+           ON roles (username) WHERE user_id IS NULL''',
+    ),
+)
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+if psycopg2 is not None:
+    # Курсор, который учитывает каждое выражение в метриках, как trace-callback в SQLite
+    class CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            count_statement(query if isinstance(query, str) else query.decode())
+            return super().execute(query, vars)
+
+
+# Повторяет транзакцию с экспоненциальной задержкой при конфликте сериализации,
+# взаимной блокировке или обрыве соединения
+def retry_on_conflict(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return func(self, *args, **kwargs)
+            except (psycopg2.extensions.TransactionRollbackError, psycopg2.OperationalError) as e:
+                if attempt == WRITE_RETRIES:
+                    raise
+                if isinstance(e, psycopg2.OperationalError):
+                    self.close()
+                delay = RETRY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+                logging.warning(f"{func.__name__}: {type(e).__name__}, retry {attempt + 1}/{WRITE_RETRIES} in {delay:.3f}s")
+                time.sleep(delay)
+    return wrapper
+
+
+# Хранилище ролей в PostgreSQL: одна база на несколько рабочих процессов бота
+class PostgresRoleStore(BaseRoleStore):
+    def __init__(self, url):
+        if psycopg2 is None:
+            raise RuntimeError("PostgreSQL storage requires psycopg2, install psycopg2-binary")
+        self.url = url
+        # Каждый поток получает своё долгоживущее соединение
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = psycopg2.connect(self.url, cursor_factory=CountingCursor)
+        # Чтение не держит открытых транзакций, запись оборачивается в _write()
+        conn.autocommit = True
+        return conn
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _fetchall(self, query, params=()):
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    # Транзакция записи: фиксируется при выходе из блока, откатывается при исключении
+    @contextmanager
+    def _write(self):
+        conn = self.conn
+        conn.autocommit = False
+        try:
+            with conn, conn.cursor() as cursor:
+                yield cursor
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+
+    @retry_on_conflict
+    def init_db(self):
+        with self._write() as cursor:
+            # Реплики запускаются одновременно: схему обновляет только одна
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+            cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+            cursor.execute('SELECT version FROM schema_version')
+            row = cursor.fetchone()
+            version = row[0] if row else 0
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(f"Database has schema version {version}, newer than supported {SCHEMA_VERSION}")
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                logging.info(f"Applying PostgreSQL migration {number}")
+                for statement in MIGRATIONS[number - 1]:
+                    cursor.execute(statement)
+            if version != SCHEMA_VERSION:
+                cursor.execute('DELETE FROM schema_version')
+                cursor.execute('INSERT INTO schema_version (version) VALUES (%s)', (SCHEMA_VERSION,))
+
+    def all_memberships(self):
+        return self._fetchall("SELECT chat_id, username, role_key FROM roles ORDER BY id")
+
+    def list_roles(self, chat_id):
+        return self._fetchall("SELECT id, role FROM role_names WHERE chat_id = %s ORDER BY role_key", (chat_id,))
+
+    def role_name(self, chat_id, role_id):
+        rows = self._fetchall("SELECT role FROM role_names WHERE id = %s AND chat_id = %s", (role_id, chat_id))
+        return rows[0][0] if rows else None
+
+    def count_roles(self, chat_id):
+        return self._fetchall("SELECT COUNT(*) FROM role_names WHERE chat_id = %s", (chat_id,))[0][0]
+
+    # Заводит роль в каталоге, если её ещё нет, и возвращает её отображаемое название
+    @staticmethod
+    def _register_role(cursor, chat_id, key, role):
+        cursor.execute('''INSERT INTO role_names (chat_id, role_key, role) VALUES (%s, %s, %s)
+                          ON CONFLICT (chat_id, role_key) DO NOTHING''', (chat_id, key, role))
+        cursor.execute("SELECT role FROM role_names WHERE chat_id = %s AND role_key = %s", (chat_id, key))
+        return cursor.fetchone()[0]
+
+    # Убирает роль из каталога, когда у неё не осталось участников
+    @staticmethod
+    def _drop_role_if_empty(cursor, chat_id, key):
+        cursor.execute('''DELETE FROM role_names WHERE chat_id = %s AND role_key = %s
+                          AND NOT EXISTS (SELECT 1 FROM roles WHERE chat_id = %s AND role_key = %s)''',
+                       (chat_id, key, chat_id, key))
+
+    def roles_with_members(self, chat_id, limit=-1, offset=0):
+        # LIMIT NULL в PostgreSQL означает "без ограничения"
+        rows = self._fetchall('''SELECT roles.role_key, roles.role, roles.username FROM roles
+                                 JOIN (SELECT role_key FROM role_names WHERE chat_id = %s
+                                       ORDER BY role_key LIMIT %s OFFSET %s) AS page
+                                 ON roles.role_key = page.role_key
+                                 WHERE roles.chat_id = %s
+                                 ORDER BY roles.role_key, roles.id''',
+                              (chat_id, limit if limit >= 0 else None, offset, chat_id))
+        roles = []
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            roles.append((group[0][1], [row[2] for row in group]))
+        return roles
+
+    def role_members(self, chat_id, role):
+        rows = self._fetchall("SELECT username FROM roles WHERE chat_id = %s AND role_key = %s ORDER BY id",
+                              (chat_id, role_key(role)))
+        return [row[0] for row in rows]
+
+    def user_roles(self, chat_id, username):
+        rows = self._fetchall("SELECT role FROM roles WHERE chat_id = %s AND username = %s", (chat_id, username))
+        return [row[0] for row in rows]
+
+    @retry_on_conflict
+    def add_member(self, chat_id, role, username):
+        key = role_key(role)
+        with self._write() as cursor:
+            display = self._register_role(cursor, chat_id, key, role)
+            psycopg2.extras.execute_values(cursor, _INSERT_MEMBER,
+                                           [(chat_id, username, display, key, username, member_user_id(username))],
+                                           template=_MEMBER_TEMPLATE)
+            added = cursor.rowcount > 0
+        return added
+
+    @retry_on_conflict
+    def add_members(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._write() as cursor:
+            display = self._register_role(cursor, chat_id, key, role)
+            psycopg2.extras.execute_values(cursor, _INSERT_MEMBER,
+                                           [(chat_id, username, display, key, username, member_user_id(username))
+                                            for username in usernames],
+                                           template=_MEMBER_TEMPLATE)
+
+    @retry_on_conflict
+    def remove_members(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._write() as cursor:
+            cursor.execute('''DELETE FROM roles WHERE chat_id = %s AND role_key = %s AND username = ANY(%s)
+                              RETURNING username''', (chat_id, key, list(usernames)))
+            deleted = {row[0] for row in cursor.fetchall()}
+            self._drop_role_if_empty(cursor, chat_id, key)
+        return [username for username in usernames if username in deleted]
+
+    @retry_on_conflict
+    def remove_role(self, chat_id, role):
+        key = role_key(role)
+        with self._write() as cursor:
+            cursor.execute("DELETE FROM roles WHERE chat_id = %s AND role_key = %s RETURNING username",
+                           (chat_id, key))
+            usernames = [row[0] for row in cursor.fetchall()]
+            cursor.execute("DELETE FROM role_names WHERE chat_id = %s AND role_key = %s", (chat_id, key))
+        return usernames
+
+    def mention_cooldowns(self):
+        return self._fetchall("SELECT chat_id, mention_cooldown FROM chat_settings "
+                              "WHERE mention_cooldown IS NOT NULL")
+
+    @retry_on_conflict
+    def set_mention_cooldown(self, chat_id, seconds):
+        with self._write() as cursor:
+            cursor.execute('''INSERT INTO chat_settings (chat_id, mention_cooldown) VALUES (%s, %s)
+                              ON CONFLICT (chat_id) DO UPDATE SET mention_cooldown = excluded.mention_cooldown''',
+                           (chat_id, seconds))
+
+    def all_users(self):
+        return self._fetchall("SELECT user_id, username, first_name FROM users")
+
+    # Переводит участников с user_id на новый ключ; если у роли уже есть участник с таким ключом,
+    # лишняя запись удаляется
+    @staticmethod
+    def _rekey_member(cursor, user_id, key):
+        # Второй EXISTS оставляет одну запись, если у пользователя в роли их несколько под разными ключами
+        cursor.execute('''DELETE FROM roles WHERE user_id = %s AND username != %s
+                          AND (EXISTS (SELECT 1 FROM roles AS other WHERE other.chat_id = roles.chat_id
+                                       AND other.role_key = roles.role_key AND other.username = %s)
+                               OR EXISTS (SELECT 1 FROM roles AS other WHERE other.chat_id = roles.chat_id
+                                          AND other.role_key = roles.role_key AND other.user_id = roles.user_id
+                                          AND other.id < roles.id))
+                          RETURNING chat_id, role_key, username''', (user_id, key, key))
+        changes = [(chat_id, role, old, key) for chat_id, role, old in cursor.fetchall()]
+        cursor.execute('''UPDATE roles SET username = %s FROM roles AS old
+                          WHERE roles.id = old.id AND roles.user_id = %s AND roles.username != %s
+                          RETURNING roles.chat_id, roles.role_key, old.username''', (key, user_id, key))
+        changes += [(chat_id, role, old, key) for chat_id, role, old in cursor.fetchall()]
+        return changes
+
+    @retry_on_conflict
+    def upsert_users(self, users):
+        changes = []
+        with self._write() as cursor:
+            for user_id, username, first_name in users:
+                if username:
+                    # username перешёл от другого пользователя: у прежнего владельца он освобождается
+                    cursor.execute('''UPDATE users SET username = NULL WHERE username = %s AND user_id != %s
+                                      RETURNING user_id''', (username, user_id))
+                    for (other,) in cursor.fetchall():
+                        changes += self._rekey_member(cursor, other, member_key(other, None))
+                cursor.execute('''INSERT INTO users (user_id, username, first_name) VALUES (%s, %s, %s)
+                                  ON CONFLICT (user_id) DO UPDATE
+                                  SET username = excluded.username, first_name = excluded.first_name''',
+                               (user_id, username, first_name))
+                key = member_key(user_id, username)
+                cursor.execute("UPDATE roles SET user_id = %s WHERE username = %s AND user_id IS NULL", (user_id, key))
+                changes += self._rekey_member(cursor, user_id, key)
+        return changes
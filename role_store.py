@@ -0,0 +1,530 @@
+import os
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from itertools import groupby
+
+from metrics import Counter, Histogram
+
+# Путь к базе данных по умолчанию
+DB_PATH = 'db/roles.db'
+
+# Адрес хранилища: путь к файлу SQLite или postgresql://... для базы, общей для рабочих процессов
+DB_URL = os.getenv('ROLES_DB_URL', DB_PATH)
+
+# Сколько миллисекунд SQLite ждёт освобождения блокировки, прежде чем вернуть "database is locked"
+BUSY_TIMEOUT_MS = int(os.getenv('ROLES_DB_BUSY_TIMEOUT_MS', '5000'))
+
+# Уровень синхронизации с диском: в режиме WAL NORMAL не теряет целостность при сбое
+SYNCHRONOUS = os.getenv('ROLES_DB_SYNCHRONOUS', 'NORMAL').upper()
+
+# Повторные попытки записи при блокировке базы данных
+WRITE_RETRIES = int(os.getenv('ROLES_DB_WRITE_RETRIES', '5'))
+RETRY_BACKOFF_SECONDS = float(os.getenv('ROLES_DB_RETRY_BACKOFF', '0.05'))
+
+# Настройки SQLite, применяемые к каждому новому соединению
+PRAGMAS = (
+    ('busy_timeout', str(BUSY_TIMEOUT_MS)),
+    ('synchronous', SYNCHRONOUS),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', '-8000'),
+)
+
+# Чат, в который переносятся роли, созданные до разделения ролей по чатам
+DEFAULT_CHAT_ID = int(os.getenv('ROLES_DEFAULT_CHAT_ID', '0'))
+
+# Число потоков, в которых выполняются запросы асинхронного хранилища
+WORKERS = int(os.getenv('ROLES_DB_WORKERS', '4'))
+
+# Размер кэша подготовленных выражений на соединение
+CACHED_STATEMENTS = 64
+
+sql_statements = Counter(
+    'roledistributor_sql_statements_total',
+    'Выполненные SQL-выражения',
+    ('statement',),
+)
+db_operations = Histogram(
+    'roledistributor_db_operation_seconds',
+    'Время операций хранилища ролей',
+    ('operation',),
+)
+db_wait = Histogram(
+    'roledistributor_db_wait_seconds',
+    'Ожидание свободного потока хранилища',
+)
+
+
+# Считает выражение по первому ключевому слову: SELECT, INSERT, DELETE...
+def count_statement(sql):
+    sql_statements.inc(statement=sql.lstrip().split(None, 1)[0].upper() if sql.strip() else '')
+
+
+# user_id участника берётся из таблицы пользователей, а для пользователя без username - из его ключа
+_INSERT_MEMBER = '''INSERT OR IGNORE INTO roles (chat_id, username, role, role_key, user_id)
+                    VALUES (?, ?, ?, ?, COALESCE((SELECT user_id FROM users WHERE username = ?), ?))'''
+
+
+
+# Нормализованный ключ роли: по нему ищутся и сравниваются роли, отображается же исходное название
+def role_key(role):
+    return role.lower()
+
+
+# Ключ участника роли: username в нижнем регистре, а для пользователя без username - "#<user_id>"
+def member_key(user_id, username):
+    return username.lower() if username else f'#{user_id}'
+
+
+# user_id из ключа участника без username; None для ключа-username
+def member_user_id(key):
+    return int(key[1:]) if key.startswith('#') else None
+
+
+# Миграции схемы. Номер применённой миграции хранится в PRAGMA user_version,
+# каждая миграция выполняется в отдельной транзакции.
+def _migration_1_initial(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS roles
+                    (username TEXT, role TEXT)''')
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_username_role
+                    ON roles (username, LOWER(role))''')
+
+
+def _migration_2_role_key(conn):
+    # LOWER() в SQLite понимает только ASCII, поэтому ключ считается в Python
+    conn.execute("ALTER TABLE roles ADD COLUMN role_key TEXT")
+    conn.execute("UPDATE roles SET role_key = role_key(role)")
+    # Одинаковые по ключу роли (например, кириллица в разном регистре) сливаются в одну
+    conn.execute('''DELETE FROM roles WHERE rowid NOT IN
+                    (SELECT MIN(rowid) FROM roles GROUP BY role_key, username)''')
+    # У роли одно отображаемое название - то, под которым она была создана первой
+    conn.execute('''UPDATE roles SET role =
+                    (SELECT first.role FROM roles AS first
+                     WHERE first.role_key = roles.role_key ORDER BY first.rowid LIMIT 1)''')
+    conn.execute("DROP INDEX IF EXISTS idx_username_role")
+    # Индексы с ключом роли в начале покрывают поиск участников и список ролей
+    conn.execute('''CREATE UNIQUE INDEX idx_roles_role_key_username
+                    ON roles (role_key, username)''')
+    conn.execute('''CREATE INDEX idx_roles_role_key_role
+                    ON roles (role_key, role)''')
+    conn.execute('''CREATE INDEX idx_roles_username
+                    ON roles (username, role)''')
+
+
+def _migration_3_chat_id(conn):
+    # Роли каждого чата живут в своём пространстве имён
+    # Старые назначения нельзя молча унести в чат 0: там их никто не увидит
+    count = conn.execute("SELECT COUNT(*) FROM roles").fetchone()[0]
+    if count and not DEFAULT_CHAT_ID:
+        raise RuntimeError(f"{count} existing role assignments have no chat, "
+                           f"set ROLES_DEFAULT_CHAT_ID to the chat they belong to and restart")
+    conn.execute("ALTER TABLE roles ADD COLUMN chat_id INTEGER")
+    conn.execute("UPDATE roles SET chat_id = ?", (DEFAULT_CHAT_ID,))
+    conn.execute("DROP INDEX idx_roles_role_key_username")
+    conn.execute("DROP INDEX idx_roles_role_key_role")
+    conn.execute("DROP INDEX idx_roles_username")
+    conn.execute('''CREATE UNIQUE INDEX idx_roles_chat_role_key_username
+                    ON roles (chat_id, role_key, username)''')
+    conn.execute('''CREATE INDEX idx_roles_chat_role_key_role
+                    ON roles (chat_id, role_key, role)''')
+    conn.execute('''CREATE INDEX idx_roles_chat_username
+                    ON roles (chat_id, username, role)''')
+
+
+def _migration_4_role_names(conn):
+    # Каталог ролей с постоянными номерами: номер роли занимает в callback_data несколько байт
+    conn.execute('''CREATE TABLE role_names
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     chat_id INTEGER NOT NULL,
+                     role_key TEXT NOT NULL,
+                     role TEXT NOT NULL)''')
+    conn.execute('''CREATE UNIQUE INDEX idx_role_names_chat_role_key
+                    ON role_names (chat_id, role_key)''')
+    conn.execute('''INSERT INTO role_names (chat_id, role_key, role)
+                    SELECT chat_id, role_key, role FROM roles
+                    GROUP BY chat_id, role_key ORDER BY MIN(rowid)''')
+
+
+def _migration_5_chat_settings(conn):
+    # Настройки чата; NULL - значение по умолчанию из переменных окружения
+    conn.execute('''CREATE TABLE chat_settings
+                    (chat_id INTEGER PRIMARY KEY,
+                     mention_cooldown REAL)''')
+
+
+def _migration_6_users(conn):
+    # Пользователи, которых бот видел в обновлениях; username хранится в нижнем регистре
+    conn.execute('''CREATE TABLE users
+                    (user_id INTEGER PRIMARY KEY,
+                     username TEXT,
+                     first_name TEXT NOT NULL)''')
+    conn.execute('''CREATE UNIQUE INDEX idx_users_username
+                    ON users (username)''')
+    # Участник роли ссылается на пользователя, как только бот узнаёт его user_id
+    conn.execute("ALTER TABLE roles ADD COLUMN user_id INTEGER")
+    conn.execute('''CREATE INDEX idx_roles_user_id
+                    ON roles (user_id) WHERE user_id IS NOT NULL''')
+    conn.execute('''CREATE INDEX idx_roles_unlinked
+                    ON roles (username) WHERE user_id IS NULL''')
+
+
+MIGRATIONS = (
+    _migration_1_initial,
+    _migration_2_role_key,
+    _migration_3_chat_id,
+    _migration_4_role_names,
+    _migration_5_chat_settings,
+    _migration_6_users,
+)
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _is_locked_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+# Повторяет запись с экспоненциальной задержкой, если база данных занята другим потоком
+def retry_on_locked(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_locked_error(e) or attempt == WRITE_RETRIES:
+                    raise
+                delay = RETRY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+                logging.warning(f"{func.__name__}: database is busy, retry {attempt + 1}/{WRITE_RETRIES} in {delay:.3f}s")
+                time.sleep(delay)
+    return wrapper
+
+
+# Интерфейс хранилища ролей: единая точка доступа к базе данных для всех обработчиков.
+# Методы синхронные и потокобезопасные; асинхронный доступ даёт AsyncRoleStore.
+class BaseRoleStore:
+    def close(self):
+        pass
+
+    # Создаёт или обновляет схему
+    def init_db(self):
+        raise NotImplementedError
+
+    # Все назначения ролей во всех чатах в порядке добавления: [(chat_id, username, ключ роли), ...]
+    def all_memberships(self):
+        raise NotImplementedError
+
+    # Список существующих ролей чата: [(номер роли, роль), ...]
+    def list_roles(self, chat_id):
+        raise NotImplementedError
+
+    # Название роли по её номеру; None, если роль уже удалена
+    def role_name(self, chat_id, role_id):
+        raise NotImplementedError
+
+    # Количество ролей в чате
+    def count_roles(self, chat_id):
+        raise NotImplementedError
+
+    # Роли чата вместе с участниками: [(роль, [участники]), ...]; с limit - одна страница ролей
+    def roles_with_members(self, chat_id, limit=-1, offset=0):
+        raise NotImplementedError
+
+    # Участники роли
+    def role_members(self, chat_id, role):
+        raise NotImplementedError
+
+    # Роли пользователя в чате
+    def user_roles(self, chat_id, username):
+        raise NotImplementedError
+
+    # Назначает роль пользователю; True, если её у него ещё не было
+    def add_member(self, chat_id, role, username):
+        raise NotImplementedError
+
+    # Назначает роль нескольким пользователям одной транзакцией
+    def add_members(self, chat_id, role, usernames):
+        raise NotImplementedError
+
+    # Снимает роль с нескольких пользователей и возвращает тех, у кого она была
+    def remove_members(self, chat_id, role, usernames):
+        raise NotImplementedError
+
+    # Удаляет роль целиком и возвращает пользователей, у которых она была
+    def remove_role(self, chat_id, role):
+        raise NotImplementedError
+
+    # Окна тишины упоминаний, заданные в чатах: [(chat_id, секунды), ...]
+    def mention_cooldowns(self):
+        raise NotImplementedError
+
+    # Задаёт окно тишины упоминаний в чате; None - вернуть значение по умолчанию
+    def set_mention_cooldown(self, chat_id, seconds):
+        raise NotImplementedError
+
+    # Все известные пользователи: [(user_id, username или None, имя), ...]
+    def all_users(self):
+        raise NotImplementedError
+
+    # Сохраняет пользователей [(user_id, username или None, имя), ...] одной транзакцией.
+    # Участники ролей привязываются к user_id, а ключи участников, сменивших username,
+    # переписываются. Возвращает изменения ключей: [(chat_id, ключ роли, старый ключ, новый ключ), ...]
+    def upsert_users(self, users):
+        raise NotImplementedError
+
+
+# Хранилище ролей в файле SQLite
+class RoleStore(BaseRoleStore):
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        # Каждый поток получает своё долгоживущее соединение
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=CACHED_STATEMENTS)
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        conn.create_function('role_key', 1, role_key, deterministic=True)
+        conn.set_trace_callback(count_statement)
+        return conn
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # Транзакция записи: блокировка берётся сразу, чтобы не получить SQLITE_BUSY при повышении блокировки
+    @contextmanager
+    def _write(self):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @retry_on_locked
+    def init_db(self):
+        # WAL сохраняется в файле базы: читатели больше не ждут писателей
+        journal_mode = self.conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            logging.warning(f"Could not enable WAL journal mode, using {journal_mode}")
+        self.migrate()
+
+    # Обновляет существующий файл базы до текущей версии схемы
+    def migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"{self.path} has schema version {version}, newer than supported {SCHEMA_VERSION}")
+        for number in range(version + 1, SCHEMA_VERSION + 1):
+            migration = MIGRATIONS[number - 1]
+            logging.info(f"Applying migration {number} ({migration.__name__}) to {self.path}")
+            with self._write() as conn:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+
+    # Все назначения ролей во всех чатах в порядке добавления
+    def all_memberships(self):
+        return self.conn.execute("SELECT chat_id, username, role_key FROM roles ORDER BY rowid").fetchall()
+
+    # Список существующих ролей чата: [(номер роли, роль), ...]
+    def list_roles(self, chat_id):
+        return self.conn.execute("SELECT id, role FROM role_names WHERE chat_id = ? ORDER BY role_key",
+                                 (chat_id,)).fetchall()
+
+    # Название роли по её номеру; None, если роль уже удалена
+    def role_name(self, chat_id, role_id):
+        row = self.conn.execute("SELECT role FROM role_names WHERE id = ? AND chat_id = ?", (role_id, chat_id)).fetchone()
+        return row[0] if row else None
+
+    # Количество ролей в чате
+    def count_roles(self, chat_id):
+        return self.conn.execute("SELECT COUNT(*) FROM role_names WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    # Заводит роль в каталоге, если её ещё нет, и возвращает её отображаемое название
+    @staticmethod
+    def _register_role(conn, chat_id, key, role):
+        conn.execute("INSERT OR IGNORE INTO role_names (chat_id, role_key, role) VALUES (?, ?, ?)", (chat_id, key, role))
+        return conn.execute("SELECT role FROM role_names WHERE chat_id = ? AND role_key = ?", (chat_id, key)).fetchone()[0]
+
+    # Убирает роль из каталога, когда у неё не осталось участников
+    @staticmethod
+    def _drop_role_if_empty(conn, chat_id, key):
+        conn.execute('''DELETE FROM role_names WHERE chat_id = ? AND role_key = ?
+                        AND NOT EXISTS (SELECT 1 FROM roles WHERE chat_id = ? AND role_key = ?)''',
+                     (chat_id, key, chat_id, key))
+
+    # Роли чата вместе с участниками одним упорядоченным проходом: [(роль, [участники]), ...].
+    # С limit читается только одна страница ролей.
+    def roles_with_members(self, chat_id, limit=-1, offset=0):
+        rows = self.conn.execute('''SELECT roles.role_key, roles.role, roles.username FROM roles
+                                    JOIN (SELECT role_key FROM role_names WHERE chat_id = ?
+                                          ORDER BY role_key LIMIT ? OFFSET ?) AS page
+                                    ON roles.role_key = page.role_key
+                                    WHERE roles.chat_id = ?
+                                    ORDER BY roles.role_key, roles.rowid''',
+                                 (chat_id, limit, offset, chat_id))
+        roles = []
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            roles.append((group[0][1], [row[2] for row in group]))
+        return roles
+
+    # Участники роли
+    def role_members(self, chat_id, role):
+        rows = self.conn.execute("SELECT username FROM roles WHERE chat_id = ? AND role_key = ?",
+                                 (chat_id, role_key(role)))
+        return [row[0] for row in rows]
+
+    # Роли пользователя в чате
+    def user_roles(self, chat_id, username):
+        rows = self.conn.execute("SELECT role FROM roles WHERE chat_id = ? AND username = ?", (chat_id, username))
+        return [row[0] for row in rows]
+
+    @retry_on_locked
+    def add_member(self, chat_id, role, username):
+        key = role_key(role)
+        with self._write() as conn:
+            display = self._register_role(conn, chat_id, key, role)
+            cursor = conn.execute(_INSERT_MEMBER, (chat_id, username, display, key, username, member_user_id(username)))
+        return cursor.rowcount > 0
+
+    # Назначает роль нескольким пользователям одной транзакцией
+    @retry_on_locked
+    def add_members(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._write() as conn:
+            display = self._register_role(conn, chat_id, key, role)
+            conn.executemany(_INSERT_MEMBER, [(chat_id, username, display, key, username, member_user_id(username))
+                                              for username in usernames])
+
+    # Снимает роль с нескольких пользователей одной транзакцией и возвращает тех, у кого она была
+    @retry_on_locked
+    def remove_members(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._write() as conn:
+            removed = [username for username in usernames
+                       if conn.execute("SELECT 1 FROM roles WHERE chat_id = ? AND role_key = ? AND username = ?",
+                                       (chat_id, key, username)).fetchone()]
+            conn.executemany("DELETE FROM roles WHERE chat_id = ? AND role_key = ? AND username = ?",
+                             [(chat_id, key, username) for username in removed])
+            self._drop_role_if_empty(conn, chat_id, key)
+        return removed
+
+    # Удаляет роль целиком и возвращает пользователей, у которых она была
+    @retry_on_locked
+    def remove_role(self, chat_id, role):
+        key = role_key(role)
+        with self._write() as conn:
+            usernames = [row[0] for row in conn.execute("SELECT username FROM roles WHERE chat_id = ? AND role_key = ?",
+                                                        (chat_id, key))]
+            conn.execute("DELETE FROM roles WHERE chat_id = ? AND role_key = ?", (chat_id, key))
+            conn.execute("DELETE FROM role_names WHERE chat_id = ? AND role_key = ?", (chat_id, key))
+        return usernames
+
+    def mention_cooldowns(self):
+        return self.conn.execute("SELECT chat_id, mention_cooldown FROM chat_settings "
+                                 "WHERE mention_cooldown IS NOT NULL").fetchall()
+
+    @retry_on_locked
+    def set_mention_cooldown(self, chat_id, seconds):
+        with self._write() as conn:
+            conn.execute('''INSERT INTO chat_settings (chat_id, mention_cooldown) VALUES (?, ?)
+                            ON CONFLICT (chat_id) DO UPDATE SET mention_cooldown = excluded.mention_cooldown''',
+                         (chat_id, seconds))
+
+    def all_users(self):
+        return self.conn.execute("SELECT user_id, username, first_name FROM users").fetchall()
+
+    # Переводит участников с user_id на новый ключ; если у роли уже есть участник с таким ключом,
+    # лишняя запись удаляется
+    @staticmethod
+    def _rekey_member(conn, user_id, key):
+        changes = []
+        rows = conn.execute("SELECT rowid, chat_id, role_key, username FROM roles WHERE user_id = ? AND username != ?",
+                            (user_id, key)).fetchall()
+        for rowid, chat_id, role, old in rows:
+            if conn.execute("SELECT 1 FROM roles WHERE chat_id = ? AND role_key = ? AND username = ?",
+                            (chat_id, role, key)).fetchone():
+                conn.execute("DELETE FROM roles WHERE rowid = ?", (rowid,))
+            else:
+                conn.execute("UPDATE roles SET username = ? WHERE rowid = ?", (key, rowid))
+            changes.append((chat_id, role, old, key))
+        return changes
+
+    @retry_on_locked
+    def upsert_users(self, users):
+        changes = []
+        with self._write() as conn:
+            for user_id, username, first_name in users:
+                if username:
+                    # username перешёл от другого пользователя: у прежнего владельца он освобождается
+                    for (other,) in conn.execute("SELECT user_id FROM users WHERE username = ? AND user_id != ?",
+                                                 (username, user_id)).fetchall():
+                        conn.execute("UPDATE users SET username = NULL WHERE user_id = ?", (other,))
+                        changes += self._rekey_member(conn, other, member_key(other, None))
+                conn.execute('''INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+                                ON CONFLICT (user_id) DO UPDATE
+                                SET username = excluded.username, first_name = excluded.first_name''',
+                             (user_id, username, first_name))
+                key = member_key(user_id, username)
+                conn.execute("UPDATE roles SET user_id = ? WHERE username = ? AND user_id IS NULL", (user_id, key))
+                changes += self._rekey_member(conn, user_id, key)
+        return changes
+
+
+# Хранилище по адресу: postgresql://... - PostgreSQL, иначе путь к файлу SQLite
+def create_store(url=DB_URL):
+    if url.startswith(('postgres://', 'postgresql://')):
+        from pg_store import PostgresRoleStore
+        return PostgresRoleStore(url)
+    return RoleStore(url)
+
+
+# Асинхронная обёртка над хранилищем ролей: каждый метод хранилища выполняется
+# в отдельном пуле потоков, а вызывающая корутина ждёт результат, не блокируя цикл событий.
+# Потоков немного, и у каждого своё соединение, так что соединение с базой не открывается заново на каждый запрос.
+class AsyncRoleStore:
+    def __init__(self, store, workers=WORKERS):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='role-store')
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._timed, func, time.perf_counter(), *args, **kwargs))
+
+    # Выполняется в потоке пула: отдельно учитываем ожидание потока и саму операцию
+    @staticmethod
+    def _timed(func, queued_at, *args, **kwargs):
+        db_wait.observe(time.perf_counter() - queued_at)
+        with db_operations.time(operation=func.__name__):
+            return func(*args, **kwargs)
+
+    def __getattr__(self, name):
+        func = getattr(self.store, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+        return call
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
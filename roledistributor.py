@@ -1,25 +1,53 @@
 import os
+import html
 import logging
-import sqlite3
 import re
+import threading
+import time
+import asyncio
+import signal
+import warnings
+import multiprocessing
+from itertools import count
 from telegram import (
-    Update,
     Bot,
-    ParseMode,
+    Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    MessageEntity,
     ReplyKeyboardMarkup,
 )
+from telegram.constants import ParseMode
 from telegram.ext import (
-    Updater,
+    Application,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
-    Filters,
-    CallbackContext,
+    ChatMemberHandler,
+    TypeHandler,
+    ContextTypes,
+    filters,
+)
+from telegram.helpers import mention_html
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning
+
+from role_store import AsyncRoleStore, create_store, member_key, member_user_id, role_key
+from deletion_queue import DeletionQueue
+from send_queue import SendQueue, HIGH, LOW
+from persistence import SQLitePersistence, STATE_DB_PATH, worker_state_path
+from metrics import Counter, Gauge, Histogram, instrument, start_http_server, METRICS_PORT
+from webhook_server import (
+    WebhookServer,
+    UpdatePartitioner,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WORKER_QUEUE_SIZE,
+    WORKER_CHECK_INTERVAL,
 )
-from telegram.utils.helpers import mention_html
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,9 +55,37 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Диалоги сознательно отслеживаются по пользователю, а не по сообщению с кнопками
+warnings.filterwarnings('ignore', message="If 'per_message=False'", category=PTBUserWarning)
+
 # Получение токена бота из переменной окружения
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Сколько секунд хранится проверенный статус администратора
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', '300'))
+
+# Сколько обновлений обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Через сколько секунд бездействия диалог завершается; 0 - не завершать.
+# Для отдельного диалога можно задать CONVERSATION_TIMEOUT_<ИМЯ>, например CONVERSATION_TIMEOUT_SETROLE
+CONVERSATION_TIMEOUT = float(os.getenv('CONVERSATION_TIMEOUT', '300'))
+
+# Как часто чистится состояние пользователей, сколько секунд хранится user_data
+# неактивного пользователя и сколько пользователей может храниться всего
+STATE_SWEEP_INTERVAL = float(os.getenv('STATE_SWEEP_INTERVAL', '600'))
+USER_DATA_TTL = float(os.getenv('USER_DATA_TTL', '3600'))
+MAX_USER_DATA = int(os.getenv('MAX_USER_DATA', '10000'))
+
+# Сколько секунд после ответа на упоминание роли в чате её участники не упоминаются снова;
+# в каждом чате администратор может задать своё значение командой /mentioncooldown
+MENTION_COOLDOWN = float(os.getenv('MENTION_COOLDOWN', '30'))
+# Наибольшее окно, которое можно задать командой, секунды
+MAX_MENTION_COOLDOWN = 24 * 60 * 60
+
+# Сколько секунд копить новых и изменившихся пользователей перед записью в базу
+USERS_FLUSH_DELAY = float(os.getenv('USERS_FLUSH_DELAY', '5'))
+
 # Определение состояний для ConversationHandler
 (
     SETROLE_CHOOSE_OPTION,
@@ -44,19 +100,740 @@ TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     ASSIGNROLE_CONFIRM,
 ) = range(10)
 
+# Хранилище ролей, общее для всех обработчиков (SQLite или PostgreSQL по ROLES_DB_URL);
+# запросы выполняются в пуле потоков, чтобы не блокировать цикл событий
+store = AsyncRoleStore(create_store())
+
+# Служебные сообщения удаляются пачками в фоне, не задерживая ответы
+deletion_queue = DeletionQueue()
+
+# Исходящие сообщения с упоминаниями идут через очередь с ограничением скорости
+send_queue = SendQueue()
+
+cache_requests = Counter(
+    'roledistributor_cache_requests_total',
+    'Обращения к кэшам в памяти',
+    ('cache', 'result'),
+)
+api_latency = Histogram(
+    'roledistributor_telegram_api_latency_seconds',
+    'Время запросов к Bot API',
+    ('method',),
+)
+# Длинный опрос getUpdates ждёт обновлений до тайм-аута и учитывается отдельно,
+# чтобы не заслонять время обычных запросов
+api_poll_latency = Histogram(
+    'roledistributor_telegram_poll_seconds',
+    'Время запросов getUpdates',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 15, 30, 60),
+)
+api_errors = Counter(
+    'roledistributor_telegram_api_errors_total',
+    'Ошибки запросов к Bot API',
+    ('method', 'error'),
+)
+
+# Транспорт Bot API, который учитывает время и ошибки каждого запроса по методу
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            api_errors.inc(method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            if api_method == 'getUpdates':
+                api_poll_latency.observe(time.perf_counter() - start)
+            else:
+                api_latency.observe(time.perf_counter() - start, method=api_method)
+        if code >= 400:
+            api_errors.inc(method=api_method, error=str(code))
+        return code, payload
+
 # Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS roles
-                 (username TEXT, role TEXT)''')
-    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_username_role
-                 ON roles (username, LOWER(role))''')  # Индекс теперь на LOWER(role)
-    conn.commit()
-    conn.close()
+async def init_db():
+    await store.init_db()
+
+users_learned = Counter(
+    'roledistributor_users_learned_total',
+    'Новые и изменившиеся пользователи, записанные в базу',
+)
+
+# Пользователи, которых бот видел в обновлениях: user_id -> (username в нижнем регистре или None, имя).
+# Изменения копятся в памяти и раз в USERS_FLUSH_DELAY секунд записываются одной транзакцией;
+# после записи ключи участников, сменивших username, переписываются и в индексе ролей.
+# Записанные изменения передаются через publish остальным рабочим процессам вебхука:
+# база переписывает участников во всех чатах, а индексы чужих чатов живут в других процессах.
+class UserDirectory:
+    def __init__(self, flush_delay=USERS_FLUSH_DELAY):
+        self.flush_delay = flush_delay
+        self._users = {}
+        # Несохранённые изменения: user_id -> (user_id, username, имя)
+        self._pending = {}
+        self._flush_task = None
+        self.publish = None
+
+    async def load(self):
+        self._users = {user_id: (username, first_name) for user_id, username, first_name in await store.all_users()}
+
+    # Вызывается на каждое обновление; для знакомого пользователя это одно сравнение
+    def observe(self, user):
+        if user is None or user.is_bot:
+            return
+        entry = (user.username.lower() if user.username else None, user.first_name)
+        if not self._remember(user.id, entry):
+            return
+        self._pending[user.id] = (user.id,) + entry
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    # Запоминает пользователя; False, если он уже известен в таком виде
+    def _remember(self, user_id, entry):
+        previous = self._users.get(user_id)
+        if previous == entry:
+            return False
+        self._users[user_id] = entry
+        if entry[0] is None and (previous is None or previous[1] != entry[1]):
+            # Имя пользователя без username появилось или сменилось - оно есть в готовых упоминаниях его ролей
+            role_index.invalidate_member(member_key(user_id, None))
+        return True
+
+    # Пользователи и переименованные участники, которых записал другой рабочий процесс
+    def apply_remote(self, users, changes):
+        for user_id, username, first_name in users:
+            self._remember(user_id, (username, first_name))
+        role_index.apply_member_changes(changes)
+
+    # Забывает пользователей не из keep; вернувшийся пользователь просто запишется в базу ещё раз
+    def retain(self, keep):
+        self._users = {user_id: entry for user_id, entry in self._users.items() if user_id in keep}
+
+    # Имя пользователя для упоминания без username
+    def name(self, user_id):
+        entry = self._users.get(user_id)
+        return entry[1] if entry is not None else str(user_id)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        users, self._pending = self._pending, {}
+        if not users:
+            return
+        try:
+            changes = await store.upsert_users(list(users.values()))
+        except Exception:
+            logging.exception(f"Failed to save {len(users)} users, will retry")
+            # Более свежие изменения тех же пользователей важнее
+            self._pending = {**users, **self._pending}
+            return
+        users_learned.inc(len(users))
+        role_index.apply_member_changes(changes)
+        if self.publish is not None:
+            self.publish((list(users.values()), changes))
+
+user_directory = UserDirectory()
+
+# Упоминание участника в сообщении с ParseMode.HTML
+def mention_fragment(key):
+    user_id = member_user_id(key)
+    if user_id is None:
+        return '@' + html.escape(key)
+    # Пользователя без username упоминаем ссылкой на user_id; пробелы в имени неразрывные,
+    # чтобы упоминания в тексте разделялись ровно одним обычным пробелом
+    return mention_html(user_id, user_directory.name(user_id).replace(' ', '\u00a0'))
+
+# Участник в обычном тексте: @username или имя пользователя без username
+def member_label(key):
+    user_id = member_user_id(key)
+    return f'@{key}' if user_id is None else user_directory.name(user_id)
+
+# Роли одного чата в памяти: ключ роли -> упорядоченное множество участников
+class ChatRoles:
+    def __init__(self, version=0):
+        self.members = {}
+        # Ключ роли -> (упоминания участников, они же одной строкой); собираются при первом упоминании роли
+        self.mentions = {}
+        # Скомпилированный шаблон по всем ролям чата, пересобирается при изменении набора ролей
+        self.pattern = None
+        # Меняется при каждом изменении набора ролей чата
+        self.version = version
+
+# Индекс ролей в памяти по всем чатам
+class RoleIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chats = {}
+        # Участники без username: ключ "#<user_id>" -> {(chat_id, ключ роли): None}.
+        # Их упоминания строятся по имени, и при смене имени сбрасываются только эти роли
+        self._by_user_id = {}
+        self._versions = count(1)
+
+    async def load(self):
+        rows = await store.all_memberships()
+
+        chats = {}
+        by_user_id = {}
+        for chat_id, username, key in rows:
+            chat = chats.get(chat_id)
+            if chat is None:
+                chat = chats[chat_id] = ChatRoles(next(self._versions))
+            # dict сохраняет порядок вставки и служит упорядоченным множеством
+            chat.members.setdefault(key, {})[username] = None
+            if member_user_id(username) is not None:
+                by_user_id.setdefault(username, {})[(chat_id, key)] = None
+        with self._lock:
+            self._chats = chats
+            self._by_user_id = by_user_id
+
+    def _link(self, chat_id, key, member):
+        if member_user_id(member) is not None:
+            self._by_user_id.setdefault(member, {})[(chat_id, key)] = None
+
+    def _unlink(self, chat_id, key, member):
+        roles = self._by_user_id.get(member)
+        if roles is not None:
+            roles.pop((chat_id, key), None)
+            if not roles:
+                del self._by_user_id[member]
+
+    # Версия набора ролей чата; 0, если в чате ещё нет ролей
+    def version(self, chat_id):
+        chat = self._chats.get(chat_id)
+        return chat.version if chat is not None else 0
+
+    def add(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatRoles()
+            role_members = chat.members.get(key)
+            if role_members is None:
+                role_members = chat.members[key] = {}
+                chat.pattern = None
+                chat.version = next(self._versions)
+            for username in usernames:
+                role_members[username] = None
+                self._link(chat_id, key, username)
+            chat.mentions.pop(key, None)
+
+    def remove(self, chat_id, role, usernames):
+        key = role_key(role)
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            role_members = chat.members.get(key) if chat is not None else None
+            if role_members is None:
+                return
+            for username in usernames:
+                role_members.pop(username, None)
+                self._unlink(chat_id, key, username)
+            chat.mentions.pop(key, None)
+            if not role_members:
+                del chat.members[key]
+                chat.pattern = None
+                chat.version = next(self._versions)
+
+    # Переносит участников на новые ключи после смены username:
+    # [(chat_id, ключ роли, старый ключ, новый ключ), ...]
+    def apply_member_changes(self, changes):
+        with self._lock:
+            for chat_id, key, old, new in changes:
+                chat = self._chats.get(chat_id)
+                role_members = chat.members.get(key) if chat is not None else None
+                if role_members is None or old not in role_members:
+                    continue
+                # Участник сохраняет своё место в порядке упоминания
+                chat.members[key] = {new if member == old else member: None for member in role_members}
+                chat.mentions.pop(key, None)
+                self._unlink(chat_id, key, old)
+                self._link(chat_id, key, new)
+
+    # user_id участников без username во всех чатах: их упоминания строятся по имени из UserDirectory
+    def member_user_ids(self):
+        with self._lock:
+            return {member_user_id(member) for member in self._by_user_id}
+
+    # Сбрасывает готовые упоминания ролей, в которых есть участник без username
+    def invalidate_member(self, member):
+        with self._lock:
+            for chat_id, key in self._by_user_id.get(member, ()):
+                chat = self._chats.get(chat_id)
+                if chat is not None:
+                    chat.mentions.pop(key, None)
+
+    # Упоминания участников роли в порядке их добавления: (фрагменты, текст)
+    def mentions(self, chat_id, role):
+        key = role_key(role)
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                return (), ''
+            entry = chat.mentions.get(key)
+            if entry is not None:
+                cache_requests.inc(cache='mentions', result='hit')
+                return entry
+            members = chat.members.get(key)
+            if not members:
+                return (), ''
+            cache_requests.inc(cache='mentions', result='miss')
+            fragments = tuple(mention_fragment(username) for username in members)
+            entry = chat.mentions[key] = (fragments, ' '.join(fragments))
+            return entry
+
+    def find_roles(self, chat_id, text):
+        # Все известные в чате роли, упомянутые в тексте как @<роль>, за один проход
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return []
+        pattern = chat.pattern
+        if pattern is None:
+            cache_requests.inc(cache='role_pattern', result='miss')
+            pattern = self._build_pattern(chat)
+        else:
+            cache_requests.inc(cache='role_pattern', result='hit')
+        if pattern is False:
+            return []
+
+        found = {}
+        for match in pattern.finditer(text):
+            found[role_key(match.group(1))] = None
+        return list(found)
+
+    def _build_pattern(self, chat):
+        with self._lock:
+            if chat.pattern is None:
+                if chat.members:
+                    # Более длинные имена первыми, чтобы @devops не совпадал как @dev
+                    roles = sorted(chat.members, key=len, reverse=True)
+                    alternation = '|'.join(re.escape(role) for role in roles)
+                    chat.pattern = re.compile(f'@({alternation})(?!\\w)', re.IGNORECASE)
+                else:
+                    chat.pattern = False
+            return chat.pattern
+
+role_index = RoleIndex()
+
+# callback_data кнопок имеет вид "<диалог>:<действие>:<значение>" и укладывается
+# в ограничение Telegram в 64 байта: вместо названия роли передаётся её номер.
+SETROLE, DELETEROLE, TAGROLE, REMOVEROLE, ASSIGNROLE, CONFIRM, ROLES = 'sr', 'dr', 'tr', 'rr', 'ar', 'ac', 'rl'
+ROLE, PAGE, BACK, CANCEL, EXISTING, NEW, YES, NO = 'r', 'p', 'b', 'c', 'e', 'n', 'y', 'x'
+
+def encode_callback(dialog, action, value=''):
+    return f'{dialog}:{action}:{value}'
+
+def decode_callback(data):
+    dialog, action, value = (data.split(':', 2) + ['', ''])[:3]
+    return dialog, action, value
+
+# Ограничение Telegram на длину одного сообщения (в единицах UTF-16)
+MAX_MESSAGE_LENGTH = 4096
+
+# Наибольшее количество ролей на одной странице /roles
+ROLES_PAGE_SIZE = 20
+
+def text_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+# Собирает строки в сообщения, каждое из которых помещается в лимит Telegram.
+# Строка, которая не помещается в текущее сообщение, переносится в следующее целиком,
+# а строка длиннее лимита делится по пробелам. Строка упоминаний передаётся парой
+# (фрагменты, текст), как в RoleIndex.mentions, и делится только между целыми фрагментами,
+# чтобы не разрезать HTML-разметку ссылки.
+def split_message(lines, limit=MAX_MESSAGE_LENGTH):
+    chunk = []
+    size = 0
+    for line in lines:
+        if isinstance(line, tuple):
+            words, line = line
+        else:
+            words = None
+        line_size = text_length(line)
+        if line_size <= limit:
+            if chunk and size + 1 + line_size > limit:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+            if chunk:
+                chunk.append('\n')
+                size += 1
+            chunk.append(line)
+            size += line_size
+            continue
+
+        separator = '\n' if chunk else ''
+        for word in words if words is not None else line.split(' '):
+            word_size = text_length(word)
+            # Слово длиннее лимита режется как есть; фрагмент упоминания не режется никогда
+            while word_size > limit and words is None:
+                if chunk:
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+                yield word[:limit // 2]
+                word = word[limit // 2:]
+                word_size = text_length(word)
+                separator = ''
+            if chunk and size + len(separator) + word_size > limit:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+                separator = ''
+            chunk.append(separator + word)
+            size += len(separator) + word_size
+            separator = ' '
+    if chunk:
+        yield ''.join(chunk)
+
+# Участники из сообщения администратора: @username через пробел и пользователи без username,
+# выбранные из списка участников чата (text_mention). Возвращает [(ключ, подпись), ...] и нераспознанное
+def parse_members(message):
+    # Смещения сущностей считаются в единицах UTF-16
+    text = message.text.encode('utf-16-le')
+    members = []
+    failed = []
+
+    def parse_words(chunk):
+        for word in chunk.decode('utf-16-le').split():
+            username = word[1:] if word.startswith('@') else word
+            if username:
+                members.append((username.lower(), f'@{username}'))
+            else:
+                failed.append(word)
+
+    position = 0
+    for entity in message.entities:
+        if entity.type == MessageEntity.TEXT_MENTION and entity.user is not None:
+            parse_words(text[position * 2:entity.offset * 2])
+            user_directory.observe(entity.user)
+            label = f'@{entity.user.username}' if entity.user.username else entity.user.full_name
+            members.append((member_key(entity.user.id, entity.user.username), label))
+            position = entity.offset + entity.length
+    parse_words(text[position * 2:])
+    return members, failed
+
+# Строка роли для /roles; список участников, не помещающийся в max_length, сокращается
+def format_role_line(role, users, max_length=None):
+    line = f'- {role} ({len(users)}): '
+    if max_length is None:
+        return line + ', '.join(member_label(username) for username in users)
+    for i, username in enumerate(users):
+        mention = member_label(username) if i == 0 else f', {member_label(username)}'
+        rest = f' … (+{len(users) - i})'
+        if text_length(line + mention) + (text_length(rest) if i < len(users) - 1 else 0) > max_length:
+            return line + rest
+        line += mention
+    return line
+
+# Текст и клавиатура страницы /roles, которая начинается с роли номер offset; читается только эта страница.
+# На страницу попадают целые строки ролей, сколько поместится в сообщение, но не больше ROLES_PAGE_SIZE;
+# остальные переходят на следующую страницу. Сокращается только роль, которая одна не помещается в сообщение.
+async def render_roles_page(chat_id, offset):
+    total = await store.count_roles(chat_id)
+    if not total:
+        return None, None
+
+    offset = min(max(offset, 0), total - 1)
+    roles = await store.roles_with_members(chat_id, limit=ROLES_PAGE_SIZE, offset=offset)
+    # Роли могли удалить между запросами
+    if not roles:
+        return None, None
+
+    # Место под заголовок с самыми длинными номерами
+    size = text_length(f'Список ролей и участников ({total}-{total} из {total}):')
+    lines = []
+    for role, users in roles:
+        line = format_role_line(role, users)
+        if size + 1 + text_length(line) > MAX_MESSAGE_LENGTH:
+            if lines:
+                break
+            line = format_role_line(role, users, MAX_MESSAGE_LENGTH - size - 1)
+        lines.append(line)
+        size += 1 + text_length(line)
+
+    end = offset + len(lines)
+    if offset == 0 and end == total:
+        header = 'Список ролей и участников:'
+    else:
+        header = f'Список ролей и участников ({offset + 1}-{end} из {total}):'
+
+    reply_markup = None
+    if offset > 0 or end < total:
+        buttons = []
+        if offset > 0:
+            previous = max(offset - ROLES_PAGE_SIZE, 0)
+            buttons.append(InlineKeyboardButton('◀', callback_data=encode_callback(ROLES, PAGE, previous)))
+        if end < total:
+            buttons.append(InlineKeyboardButton('▶', callback_data=encode_callback(ROLES, PAGE, end)))
+        reply_markup = InlineKeyboardMarkup([buttons])
+    return '\n'.join([header] + lines), reply_markup
+
+# Количество ролей на одной странице клавиатуры выбора роли
+KEYBOARD_PAGE_SIZE = 10
+
+# Кнопка под списком ролей для каждого диалога выбора роли
+ROLE_KEYBOARD_FOOTERS = {
+    SETROLE: ('Назад', BACK),
+    DELETEROLE: ('Назад', BACK),
+    TAGROLE: ('Отмена', CANCEL),
+    REMOVEROLE: ('Отмена', CANCEL),
+    ASSIGNROLE: ('Отмена', CANCEL),
+}
+
+# Клавиатуры выбора роли с постраничной навигацией и поиск роли по номеру.
+# Роли и отрисованные страницы кэшируются по чатам и сбрасываются при изменении набора ролей чата.
+class RoleKeyboards:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # chat_id -> (версия набора ролей, [(номер, роль)], {номер: роль}, {(диалог, страница): клавиатура})
+        self._chats = {}
+
+    async def _entry(self, chat_id):
+        version = role_index.version(chat_id)
+        with self._lock:
+            entry = self._chats.get(chat_id)
+        cache_requests.inc(cache='role_keyboards', result='hit' if entry is not None and entry[0] == version else 'miss')
+        if entry is None or entry[0] != version:
+            roles = await store.list_roles(chat_id)
+            entry = (version, roles, dict(roles), {})
+            with self._lock:
+                self._chats[chat_id] = entry
+        return entry
+
+    async def get(self, chat_id, dialog, page=0):
+        _, roles, _, pages = await self._entry(chat_id)
+        if not roles:
+            return None
+
+        page_count = (len(roles) + KEYBOARD_PAGE_SIZE - 1) // KEYBOARD_PAGE_SIZE
+        page = min(max(page, 0), page_count - 1)
+        reply_markup = pages.get((dialog, page))
+        cache_requests.inc(cache='role_keyboard_pages', result='hit' if reply_markup is not None else 'miss')
+        if reply_markup is None:
+            reply_markup = pages[(dialog, page)] = self._render(dialog, roles, page, page_count)
+        return reply_markup
+
+    # Название роли по номеру из callback_data; None, если роли уже нет
+    async def role_name(self, chat_id, role_id):
+        role = (await self._entry(chat_id))[2].get(role_id)
+        if role is None:
+            role = await store.role_name(chat_id, role_id)
+        return role
+
+    @staticmethod
+    def _render(dialog, roles, page, page_count):
+        keyboard = []
+        for role_id, role in roles[page * KEYBOARD_PAGE_SIZE:(page + 1) * KEYBOARD_PAGE_SIZE]:
+            keyboard.append([InlineKeyboardButton(role, callback_data=encode_callback(dialog, ROLE, role_id))])
+        if page_count > 1:
+            buttons = []
+            if page > 0:
+                buttons.append(InlineKeyboardButton(f'◀ {page}/{page_count}', callback_data=encode_callback(dialog, PAGE, page - 1)))
+            if page < page_count - 1:
+                buttons.append(InlineKeyboardButton(f'{page + 2}/{page_count} ▶', callback_data=encode_callback(dialog, PAGE, page + 1)))
+            keyboard.append(buttons)
+        text, action = ROLE_KEYBOARD_FOOTERS[dialog]
+        keyboard.append([InlineKeyboardButton(text, callback_data=encode_callback(dialog, action))])
+        return InlineKeyboardMarkup(keyboard)
+
+role_keyboards = RoleKeyboards()
+
+# Общий маршрутизатор нажатий на inline-кнопки. Он разбирает callback_data,
+# сам листает клавиатуры выбора роли, подставляет название роли вместо её номера
+# и вызывает обработчик диалога как callback(update, context, action, value).
+class CallbackRouter:
+    def __init__(self):
+        self._routes = {}
+
+    def register(self, dialog, callback):
+        self._routes[dialog] = callback
+
+    # Обработчик для состояний ConversationHandler: принимает только кнопки своего диалога
+    def handler(self, dialog):
+        return CallbackQueryHandler(self.dispatch, pattern=f'^{dialog}:')
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        dialog, action, value = decode_callback(query.data)
+        chat_id = query.message.chat.id
+
+        if dialog in ROLE_KEYBOARD_FOOTERS and action == PAGE:
+            await query.answer()
+            reply_markup = await role_keyboards.get(chat_id, dialog, int(value))
+            if reply_markup is not None:
+                try:
+                    await query.edit_message_reply_markup(reply_markup=reply_markup)
+                except Exception as e:
+                    logging.warning(f"Could not switch role keyboard page: {e}")
+            # Состояние диалога не меняется
+            return None
+
+        if dialog in ROLE_KEYBOARD_FOOTERS and action == ROLE:
+            role = await role_keyboards.role_name(chat_id, int(value))
+            if role is None:
+                await query.answer('Эта роль уже удалена.')
+                reply_markup = await role_keyboards.get(chat_id, dialog)
+                try:
+                    if reply_markup is not None:
+                        await query.edit_message_reply_markup(reply_markup=reply_markup)
+                except Exception as e:
+                    logging.warning(f"Could not refresh role keyboard: {e}")
+                return None
+            value = role
+
+        return await self._routes[dialog](update, context, action, value)
+
+callback_router = CallbackRouter()
+
+ADMIN_STATUSES = ('administrator', 'creator')
+
+# Кэш статуса администратора (chat_id, user_id) -> администратор ли пользователь.
+# Первый запрос в чате загружает сразу всех администраторов через get_chat_administrators,
+# обновления ChatMemberHandler поддерживают кэш в актуальном состоянии.
+class AdminCache:
+    def __init__(self, ttl=ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # chat_id -> (истекает, множество user_id администраторов)
+        self._chats = {}
+        # (chat_id, user_id) -> (истекает, администратор ли) для чатов, где список администраторов недоступен
+        self._members = {}
+
+    async def is_admin(self, bot, chat_id, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is not None and entry[0] > now:
+                cache_requests.inc(cache='admins', result='hit')
+                return user_id in entry[1]
+            entry = self._members.get((chat_id, user_id))
+            if entry is not None and entry[0] > now:
+                cache_requests.inc(cache='admins', result='hit')
+                return entry[1]
+        cache_requests.inc(cache='admins', result='miss')
+
+        try:
+            admins = await bot.get_chat_administrators(chat_id)
+        except Exception as e:
+            # Например, в личном чате администраторов нет - проверяем одного пользователя
+            logging.debug(f"get_chat_administrators failed for chat {chat_id}: {e}")
+            is_admin = (await bot.get_chat_member(chat_id, user_id)).status in ADMIN_STATUSES
+            with self._lock:
+                self._members[(chat_id, user_id)] = (now + self.ttl, is_admin)
+            return is_admin
+
+        admin_ids = {admin.user.id for admin in admins if admin.status in ADMIN_STATUSES}
+        with self._lock:
+            self._chats[chat_id] = (now + self.ttl, admin_ids)
+        return user_id in admin_ids
+
+    # Обновление статуса участника из ChatMemberUpdated
+    def update_member(self, chat_id, user_id, status):
+        with self._lock:
+            self._members.pop((chat_id, user_id), None)
+            entry = self._chats.get(chat_id)
+            if entry is not None:
+                if status in ADMIN_STATUSES:
+                    entry[1].add(user_id)
+                else:
+                    entry[1].discard(user_id)
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+            for key in [key for key in self._members if key[0] == chat_id]:
+                del self._members[key]
+
+admin_cache = AdminCache()
+
+mention_replies = Counter(
+    'roledistributor_mention_replies_total',
+    'Ответы на упоминания ролей: полный список, ссылка на прошлый ответ или ничего',
+    ('result',),
+)
+
+# Ответ на упоминание ролей; номер сообщения известен, когда очередь его отправит
+class MentionReply:
+    def __init__(self):
+        self.message_id = None
+        # Ссылка на этот ответ уже отправлялась
+        self.referenced = False
+
+    def sent(self, message):
+        self.message_id = message.message_id
+
+# Окна тишины упоминаний по чатам и ролям.
+# После ответа на @роль её участники в течение окна не упоминаются снова: повторные упоминания
+# склеиваются с уже поставленным в очередь ответом или получают короткую ссылку на него.
+class MentionCooldowns:
+    def __init__(self, default=MENTION_COOLDOWN, limit=MAX_USER_DATA):
+        self.default = default
+        self.limit = limit
+        # chat_id -> окно в секундах, заданное в чате
+        self._windows = {}
+        # (chat_id, ключ роли) -> (истекает, MentionReply)
+        self._replies = {}
+
+    async def load(self):
+        self._windows = dict(await store.mention_cooldowns())
+
+    def window(self, chat_id):
+        return self._windows.get(chat_id, self.default)
+
+    # None возвращает значение по умолчанию
+    async def set_window(self, chat_id, seconds):
+        await store.set_mention_cooldown(chat_id, seconds)
+        if seconds is None:
+            self._windows.pop(chat_id, None)
+        else:
+            self._windows[chat_id] = seconds
+        for key in [key for key in self._replies if key[0] == chat_id]:
+            del self._replies[key]
+
+    # Делит упомянутые роли на те, которым нужен полный ответ, и недавние ответы по остальным
+    def split(self, chat_id, roles, now):
+        fresh = []
+        recent = []
+        for role in roles:
+            entry = self._replies.get((chat_id, role))
+            if entry is not None and entry[0] > now:
+                recent.append(entry[1])
+            else:
+                fresh.append(role)
+        return fresh, recent
+
+    # Запоминает ответ на роли; окно отсчитывается от момента упоминания
+    def remember(self, chat_id, roles, now):
+        reply = MentionReply()
+        window = self.window(chat_id)
+        if window <= 0:
+            return reply
+        if len(self._replies) > self.limit:
+            self._replies = {key: entry for key, entry in self._replies.items() if entry[0] > now}
+        for role in roles:
+            self._replies[(chat_id, role)] = (now + window, reply)
+        return reply
+
+mention_cooldowns = MentionCooldowns()
+
+# Изменение статуса участника чата: поддерживаем кэш администраторов
+@instrument
+async def chat_member_updated(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.my_chat_member is not None:
+        # Изменились права самого бота - список администраторов перечитаем при следующей проверке
+        admin_cache.invalidate(update.my_chat_member.chat.id)
+        return
+    member_update = update.chat_member
+    admin_cache.update_member(member_update.chat.id,
+                              member_update.new_chat_member.user.id,
+                              member_update.new_chat_member.status)
 
 # Команда /start
-def start_command(update: Update, context: CallbackContext):
+@instrument
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     welcome_text = f"Привет, {user.first_name}! Я бот для управления ролями в группе."
 
@@ -71,16 +848,14 @@ def start_command(update: Update, context: CallbackContext):
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
-    sent_message = update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    sent_message = await update.message.reply_text(welcome_text, reply_markup=reply_markup)
 
     # Удаляем сообщение пользователя с командой
-    try:
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
 
 # Команда /help
-def help_command(update: Update, context: CallbackContext):
+@instrument
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = (
         "Я бот для управления ролями в группе.\n\n"
         "Доступные команды:\n"
@@ -91,6 +866,7 @@ def help_command(update: Update, context: CallbackContext):
         "/assignrole - Самостоятельно добавить себе роль.\n"
         "/roles - Показать все роли и участников.\n"
         "/tagrole - Упомянуть участников роли.\n"
+        "/mentioncooldown - Показать или задать паузу между упоминаниями одной роли.\n"
         "/help - Показать это сообщение.\n\n"
         "Вы также можете использовать `@<роль>` в вашем сообщении, чтобы упомянуть всех участников этой роли.\n"
         "Например: `@dev Привет, команда!`"
@@ -99,188 +875,218 @@ def help_command(update: Update, context: CallbackContext):
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
-    update.message.reply_text(help_text)
+    await update.message.reply_text(help_text)
 
     # Удаляем сообщение пользователя с командой
-    try:
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
 
 # Команда /roles
-def list_roles(update: Update, context: CallbackContext):
+@instrument
+async def list_roles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
     try:
-        conn = sqlite3.connect('db/roles.db')
-        c = conn.cursor()
-        c.execute("SELECT role FROM roles GROUP BY role")
-        roles = c.fetchall()
-
-        if roles:
-            message = 'Список ролей и участников:\n'
-            for role_tuple in roles:
-                role = role_tuple[0]
-                c.execute("SELECT username FROM roles WHERE role = ?", (role,))
-                users = c.fetchall()
-                user_mentions = [f'@{username[0]}' for username in users]
-                user_list = ', '.join(user_mentions)
-                message += f'- {role} ({len(user_mentions)}): {user_list}\n'
-            conn.close()
-            update.message.reply_text(message)
+        message, reply_markup = await render_roles_page(update.effective_chat.id, 0)
+
+        if message:
+            await update.message.reply_text(message, reply_markup=reply_markup)
         else:
-            update.message.reply_text('Пока нет назначенных ролей.')
+            await update.message.reply_text('Пока нет назначенных ролей.')
     except Exception as e:
         logging.error(f"Exception in list_roles: {e}", exc_info=True)
-        update.message.reply_text('Произошла ошибка при получении списка ролей.')
+        await update.message.reply_text('Произошла ошибка при получении списка ролей.')
 
     # Удаляем сообщение пользователя с командой
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
+
+# Переключение страниц /roles
+@instrument
+async def list_roles_page(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
+    query = update.callback_query
+    await query.answer()
+    offset = int(value)
+
     try:
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
+        message, reply_markup = await render_roles_page(query.message.chat.id, offset)
+        if message:
+            await query.edit_message_text(message, reply_markup=reply_markup)
+        else:
+            await query.edit_message_text('Пока нет назначенных ролей.')
+    except Exception as e:
+        logging.error(f"Exception in list_roles_page: {e}", exc_info=True)
+
+# Команда /mentioncooldown [секунды|default]: пауза между упоминаниями одной роли в чате
+@instrument
+async def mention_cooldown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Сохраняем ID сообщения пользователя с командой
+    context.user_data['user_command_message_id'] = update.message.message_id
+
+    chat = update.effective_chat
+
+    if not context.args:
+        window = mention_cooldowns.window(chat.id)
+        if window > 0:
+            await update.message.reply_text(f'Пауза между упоминаниями одной роли: {window:g} с.')
+        else:
+            await update.message.reply_text('Пауза между упоминаниями ролей отключена.')
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
+        return
+
+    # Проверяем, является ли пользователь администратором
+    try:
+        if not await admin_cache.is_admin(context.bot, chat.id, update.message.from_user.id):
+            await update.message.reply_text('Только администратор может менять паузу между упоминаниями.')
+            deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
+            return
     except:
-        pass
+        await update.message.reply_text('Не удалось проверить ваши права. Попробуйте позже.')
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
+        return
+
+    value = context.args[0].lower()
+    try:
+        seconds = None if value == 'default' else float(value)
+    except ValueError:
+        seconds = -1
+    if seconds is not None and not 0 <= seconds <= MAX_MENTION_COOLDOWN:
+        await update.message.reply_text(
+            f'Укажите паузу в секундах от 0 до {MAX_MENTION_COOLDOWN} или default для значения по умолчанию, '
+            f'например: /mentioncooldown 60')
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
+        return
+
+    await mention_cooldowns.set_window(chat.id, seconds)
+    window = mention_cooldowns.window(chat.id)
+    if window > 0:
+        await update.message.reply_text(f'Пауза между упоминаниями одной роли теперь {window:g} с.')
+    else:
+        await update.message.reply_text('Пауза между упоминаниями ролей отключена.')
+
+    # Удаляем сообщение пользователя с командой
+    deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
+
+# Ответ на команду диалога. При возврате кнопкой "Назад" обновление приходит без message,
+# а сообщение с кнопками удаляется, поэтому ответ просто отправляется в чат
+async def reply_to_command(update: Update, text, **kwargs):
+    if update.message is not None:
+        return await update.message.reply_text(text, **kwargs)
+    return await update.effective_chat.send_message(text, **kwargs)
 
 # Команда /setrole
-def setrole_start(update: Update, context: CallbackContext):
+@instrument
+async def setrole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # При возврате кнопкой "Назад" команда пользователя остаётся прежней
+    if update.callback_query is not None:
+        command_message_id = context.user_data.get('user_command_message_id')
+    else:
+        command_message_id = update.message.message_id
+
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
     # Сохраняем ID сообщения пользователя с командой
-    context.user_data['user_command_message_id'] = update.message.message_id
+    context.user_data['user_command_message_id'] = command_message_id
 
-    user = update.message.from_user
+    user = update.effective_user
     chat = update.effective_chat
 
     # Проверяем, является ли пользователь администратором
     try:
-        member = context.bot.get_chat_member(chat.id, user.id)
-        if member.status not in ['administrator', 'creator']:
-            update.message.reply_text('Только администратор может назначать роли.')
+        if not await admin_cache.is_admin(context.bot, chat.id, user.id):
+            await reply_to_command(update, 'Только администратор может назначать роли.')
             # Удаляем сообщение пользователя с командой
-            try:
-                context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-            except:
-                pass
+            deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
             return ConversationHandler.END
     except:
-        update.message.reply_text('Не удалось проверить ваши права. Попробуйте позже.')
+        await reply_to_command(update, 'Не удалось проверить ваши права. Попробуйте позже.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
     # Предлагаем выбрать существующую роль или создать новую
     keyboard = [
-        [InlineKeyboardButton('Выбрать существующую роль', callback_data='setrole_existing')],
-        [InlineKeyboardButton('Создать новую роль', callback_data='setrole_new')],
-        [InlineKeyboardButton('Отмена', callback_data='cancel')]
+        [InlineKeyboardButton('Выбрать существующую роль', callback_data=encode_callback(SETROLE, EXISTING))],
+        [InlineKeyboardButton('Создать новую роль', callback_data=encode_callback(SETROLE, NEW))],
+        [InlineKeyboardButton('Отмена', callback_data=encode_callback(SETROLE, CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    sent_message = update.message.reply_text('Выберите опцию:', reply_markup=reply_markup)
+    sent_message = await reply_to_command(update, 'Выберите опцию:', reply_markup=reply_markup)
     context.user_data['message_to_delete'] = sent_message.message_id
 
     return SETROLE_CHOOSE_OPTION
 
-def setrole_option_callback(update: Update, context: CallbackContext):
+@instrument
+async def setrole_option_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'cancel':
-        try:
-            query.message.delete()
-        except:
-            pass
+    if action == CANCEL:
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=query.message.chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(query.message.chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
     context.user_data['setrole'] = {}
 
-    if data == 'setrole_existing':
+    if action == EXISTING:
         # Предлагаем выбрать существующую роль
-        conn = sqlite3.connect('db/roles.db')
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT role FROM roles")
-        results = c.fetchall()
-        conn.close()
-
-        if results:
-            keyboard = []
-            for role_tuple in results:
-                role = role_tuple[0]
-                keyboard.append([InlineKeyboardButton(role, callback_data=f'setrole_role:{role}')])
-            keyboard.append([InlineKeyboardButton('Назад', callback_data='back')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text('Выберите роль:', reply_markup=reply_markup)
+        reply_markup = await role_keyboards.get(query.message.chat.id, SETROLE)
+
+        if reply_markup is not None:
+            await query.edit_message_text('Выберите роль:', reply_markup=reply_markup)
             return SETROLE_CHOOSE_OPTION
         else:
-            query.edit_message_text('Пока нет доступных ролей.')
+            await query.edit_message_text('Пока нет доступных ролей.')
             return ConversationHandler.END
-    elif data == 'setrole_new':
+    elif action == NEW:
         # Запрашиваем название новой роли
-        query.edit_message_text('Пожалуйста, введите название новой роли:')
+        await query.edit_message_text('Пожалуйста, введите название новой роли:')
         return SETROLE_ENTER_ROLE_NAME
-    elif data.startswith('setrole_role:'):
-        role = data.split(':', 1)[1]
+    elif action == ROLE:
+        role = value
         context.user_data['setrole']['role'] = role
-        query.edit_message_text(f'Вы выбрали роль "{role}". Теперь введите @username пользователей через пробел для назначения роли:')
+        await query.edit_message_text(f'Вы выбрали роль "{role}". Теперь введите @username пользователей через пробел для назначения роли:')
         return SETROLE_SELECT_USER
-    elif data == 'back':
+    elif action == BACK:
         # Возвращаемся к выбору опции
-        try:
-            query.message.delete()
-        except:
-            pass
-        return setrole_start(update, context)
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
+        return await setrole_start(update, context)
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
-def setrole_new_role_name(update: Update, context: CallbackContext):
+@instrument
+async def setrole_new_role_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role_name = update.message.text.strip()
     if not role_name:
-        update.message.reply_text('Название роли не может быть пустым. Попробуйте снова или нажмите /cancel для отмены.')
+        await update.message.reply_text('Название роли не может быть пустым. Попробуйте снова или нажмите /cancel для отмены.')
         return SETROLE_ENTER_ROLE_NAME
 
     context.user_data['setrole']['role'] = role_name
-    sent_message = update.message.reply_text(f'Роль "{role_name}" создана. Теперь введите @username пользователей через пробел для назначения роли:')
+    sent_message = await update.message.reply_text(f'Роль "{role_name}" создана. Теперь введите @username пользователей через пробел для назначения роли:')
     context.user_data['message_to_delete'] = sent_message.message_id
     return SETROLE_SELECT_USER
 
-def setrole_select_user(update: Update, context: CallbackContext):
+@instrument
+async def setrole_select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = context.user_data['setrole'].get('role')
     if not role:
-        update.message.reply_text('Произошла ошибка. Роль не найдена.')
+        await update.message.reply_text('Произошла ошибка. Роль не найдена.')
         return ConversationHandler.END
 
-    usernames = update.message.text.strip().split()
-    if not usernames:
-        update.message.reply_text('Пожалуйста, укажите @username пользователей через пробел или нажмите /cancel для отмены.')
+    members, failed_users = parse_members(update.message)
+    if not members and not failed_users:
+        await update.message.reply_text('Пожалуйста, укажите @username пользователей через пробел или нажмите /cancel для отмены.')
         return SETROLE_SELECT_USER
 
-    success_users = []
-    failed_users = []
-
-    for username in usernames:
-        if username.startswith('@'):
-            username = username[1:]
-        if username:
-            conn = sqlite3.connect('db/roles.db')
-            c = conn.cursor()
-            c.execute("INSERT OR IGNORE INTO roles (username, role) VALUES (?, ?)", (username.lower(), role))
-            conn.commit()
-            conn.close()
-            success_users.append(f'@{username}')
-        else:
-            failed_users.append(username)
+    valid_usernames = [key for key, _ in members]
+    success_users = [label for _, label in members]
+
+    # Назначаем роль всем пользователям одной транзакцией
+    if valid_usernames:
+        await store.add_members(update.effective_chat.id, role, valid_usernames)
+        role_index.add(update.effective_chat.id, role, valid_usernames)
 
     message = ''
     if success_users:
@@ -288,169 +1094,136 @@ def setrole_select_user(update: Update, context: CallbackContext):
     if failed_users:
         message += f'Не удалось назначить роль пользователям: {" ".join(failed_users)}.\n'
 
-    update.message.reply_text(message)
+    await update.message.reply_text(message)
 
     # Удаляем системные сообщения бота
-    try:
-        if 'message_to_delete' in context.user_data:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
     # Удаляем сообщения пользователя с командой и вводом
-    try:
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
+    deletion_queue.delete(update.effective_chat.id, update.message.message_id)
 
     return ConversationHandler.END
 
 # Команда /getrole
-def getrole_start(update: Update, context: CallbackContext):
+@instrument
+async def getrole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
-    sent_message = update.message.reply_text('Пожалуйста, введите @username пользователя для получения его ролей:')
+    sent_message = await update.message.reply_text('Пожалуйста, введите @username пользователя для получения его ролей:')
     context.user_data['message_to_delete'] = sent_message.message_id
     return GETROLE_ENTER_USERNAME
 
-def getrole_enter_username(update: Update, context: CallbackContext):
-    username = update.message.text.strip()
-    if username.startswith('@'):
-        username = username[1:]
+@instrument
+async def getrole_enter_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    members, _ = parse_members(update.message)
+    if not members:
+        await update.message.reply_text('Пожалуйста, введите @username пользователя или нажмите /cancel для отмены.')
+        return GETROLE_ENTER_USERNAME
+    key, label = members[0]
 
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute("SELECT role FROM roles WHERE username = ?", (username.lower(),))
-    results = c.fetchall()
-    conn.close()
+    results = await store.user_roles(update.effective_chat.id, key)
 
     if results:
-        roles = ', '.join([row[0] for row in results])
-        update.message.reply_text(f'Роли пользователя @{username}: {roles}')
+        roles = ', '.join(results)
+        await update.message.reply_text(f'Роли пользователя {label}: {roles}')
     else:
-        update.message.reply_text(f'У пользователя @{username} нет назначенных ролей.')
+        await update.message.reply_text(f'У пользователя {label} нет назначенных ролей.')
 
     # Удаляем сообщения пользователя с командой и вводом
-    try:
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
+    deletion_queue.delete(update.effective_chat.id, update.message.message_id)
 
     # Удаляем системные сообщения бота
-    try:
-        if 'message_to_delete' in context.user_data:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
     return ConversationHandler.END
 
 # Команда /deleterole
-def deleterole_start(update: Update, context: CallbackContext):
+@instrument
+async def deleterole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # При возврате кнопкой "Назад" команда пользователя остаётся прежней
+    if update.callback_query is not None:
+        command_message_id = context.user_data.get('user_command_message_id')
+    else:
+        command_message_id = update.message.message_id
+
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
     # Сохраняем ID сообщения пользователя с командой
-    context.user_data['user_command_message_id'] = update.message.message_id
+    context.user_data['user_command_message_id'] = command_message_id
 
-    user = update.message.from_user
+    user = update.effective_user
     chat = update.effective_chat
 
     # Проверяем, является ли пользователь администратором
     try:
-        member = context.bot.get_chat_member(chat.id, user.id)
-        if member.status not in ['administrator', 'creator']:
-            update.message.reply_text('Только администратор может удалять роли.')
+        if not await admin_cache.is_admin(context.bot, chat.id, user.id):
+            await reply_to_command(update, 'Только администратор может удалять роли.')
             # Удаляем сообщение пользователя с командой
-            try:
-                context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-            except:
-                pass
+            deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
             return ConversationHandler.END
     except:
-        update.message.reply_text('Не удалось проверить ваши права. Попробуйте позже.')
+        await reply_to_command(update, 'Не удалось проверить ваши права. Попробуйте позже.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-    sent_message = update.message.reply_text('Пожалуйста, введите @username пользователей через пробел, у которых вы хотите удалить роль:')
+    sent_message = await reply_to_command(update, 'Пожалуйста, введите @username пользователей через пробел, у которых вы хотите удалить роль:')
     context.user_data['message_to_delete'] = sent_message.message_id
     return DELETEROLE_SELECT_USER
 
-def deleterole_select_user(update: Update, context: CallbackContext):
-    usernames = update.message.text.strip().split()
-    if not usernames:
-        update.message.reply_text('Пожалуйста, укажите @username пользователей через пробел или нажмите /cancel для отмены.')
+@instrument
+async def deleterole_select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    members, failed_users = parse_members(update.message)
+    if not members and not failed_users:
+        await update.message.reply_text('Пожалуйста, укажите @username пользователей через пробел или нажмите /cancel для отмены.')
         return DELETEROLE_SELECT_USER
 
-    context.user_data['deleterole'] = {'usernames': usernames}
+    context.user_data['deleterole'] = {'members': members, 'failed': failed_users}
 
     # Предлагаем выбрать роль для удаления
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT role FROM roles")
-    results = c.fetchall()
-    conn.close()
+    reply_markup = await role_keyboards.get(update.effective_chat.id, DELETEROLE)
 
-    if results:
-        keyboard = []
-        for role_tuple in results:
-            role = role_tuple[0]
-            keyboard.append([InlineKeyboardButton(role, callback_data=f'deleterole_role:{role}')])
-        keyboard.append([InlineKeyboardButton('Назад', callback_data='back')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        sent_message = update.message.reply_text('Выберите роль для удаления у указанных пользователей:', reply_markup=reply_markup)
+    if reply_markup is not None:
+        sent_message = await update.message.reply_text('Выберите роль для удаления у указанных пользователей:', reply_markup=reply_markup)
         context.user_data['message_to_delete'] = sent_message.message_id
         return DELETEROLE_SELECT_ROLE
     else:
-        update.message.reply_text('Пока нет доступных ролей.')
+        await update.message.reply_text('Пока нет доступных ролей.')
         return ConversationHandler.END
 
-def deleterole_role_callback(update: Update, context: CallbackContext):
+@instrument
+async def deleterole_role_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'back':
-        try:
-            query.message.delete()
-        except:
-            pass
-        return deleterole_start(update, context)
+    if action == BACK:
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
+        return await deleterole_start(update, context)
 
-    if data.startswith('deleterole_role:'):
-        role = data.split(':', 1)[1]
+    if action == ROLE:
+        role = value
 
-        usernames = context.user_data['deleterole'].get('usernames')
-        if not usernames:
-            query.edit_message_text('Произошла ошибка. Пользователи не найдены.')
+        members = context.user_data['deleterole'].get('members')
+        failed_users = context.user_data['deleterole'].get('failed', [])
+        if not members and not failed_users:
+            await query.edit_message_text('Произошла ошибка. Пользователи не найдены.')
             return ConversationHandler.END
 
-        success_users = []
-        failed_users = []
+        # После восстановления из базы пары (ключ, подпись) приходят списками
+        valid_usernames = [key for key, _ in members]
+        success_users = [label for _, label in members]
 
-        for username in usernames:
-            if username.startswith('@'):
-                username = username[1:]
-            if username:
-                conn = sqlite3.connect('db/roles.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM roles WHERE username = ? AND role = ?", (username.lower(), role))
-                conn.commit()
-                conn.close()
-                success_users.append(f'@{username}')
-            else:
-                failed_users.append(username)
+        # Удаляем роль у всех пользователей одной транзакцией
+        if valid_usernames:
+            removed = await store.remove_members(update.effective_chat.id, role, valid_usernames)
+            role_index.remove(update.effective_chat.id, role, removed)
 
         message = ''
         if success_users:
@@ -458,142 +1231,87 @@ def deleterole_role_callback(update: Update, context: CallbackContext):
         if failed_users:
             message += f'Не удалось удалить роль у пользователей: {" ".join(failed_users)}.\n'
 
-        query.edit_message_text(message)
+        await query.edit_message_text(message)
 
         # Удаляем системные сообщения бота
-        try:
-            if 'message_to_delete' in context.user_data:
-                context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
         # Удаляем сообщения пользователя с командой и вводом
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.callback_query.message.message_id)
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
+        deletion_queue.delete(update.effective_chat.id, update.callback_query.message.message_id)
 
         return ConversationHandler.END
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
 # Команда /tagrole
-def tagrole_start(update: Update, context: CallbackContext):
+@instrument
+async def tagrole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT role FROM roles")
-    results = c.fetchall()
-    conn.close()
-
-    if results:
-        keyboard = []
-        for role_tuple in results:
-            role = role_tuple[0]
-            keyboard.append([InlineKeyboardButton(role, callback_data=f'tagrole_role:{role}')])
-        keyboard.append([InlineKeyboardButton('Отмена', callback_data='cancel')])
+    reply_markup = await role_keyboards.get(update.effective_chat.id, TAGROLE)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        sent_message = update.message.reply_text('Выберите роль для тегирования:', reply_markup=reply_markup)
+    if reply_markup is not None:
+        sent_message = await update.message.reply_text('Выберите роль для тегирования:', reply_markup=reply_markup)
         context.user_data['message_to_delete'] = sent_message.message_id
         return TAGROLE_CHOOSE_ROLE
     else:
-        update.message.reply_text('Пока нет доступных ролей.')
+        await update.message.reply_text('Пока нет доступных ролей.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-def tagrole_choose_role(update: Update, context: CallbackContext):
+@instrument
+async def tagrole_choose_role(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'cancel':
-        try:
-            query.message.delete()
-        except:
-            pass
+    if action == CANCEL:
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-    if data.startswith('tagrole_role:'):
-        role = data.split(':', 1)[1]
+    if action == ROLE:
+        role = value
         context.user_data['tagrole'] = {'role': role}
 
         # Удаляем сообщение с выбором роли
-        try:
-            query.message.delete()
-            if 'message_to_delete' in context.user_data:
-                context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-        except:
-            pass
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
-
-        # Получаем список пользователей с данной ролью
-        conn = sqlite3.connect('db/roles.db')
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT username FROM roles WHERE role = ?", (role,))
-        users = c.fetchall()
-        conn.close()
-
-        if users:
-            mentions = [f'@{username_tuple[0]}' for username_tuple in users]
-            # Убираем дубликаты
-            unique_mentions = list(set(mentions))
-            mentions_text = ' '.join(unique_mentions)
-
-            # Отправляем сообщение с упоминаниями
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f'Участники роли "{role}":\n{mentions_text}',
-                parse_mode=ParseMode.HTML
-            )
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
+
+        # Упоминания участников роли из индекса в памяти
+        fragments, mentions_text = role_index.mentions(update.effective_chat.id, role)
+
+        if fragments:
+            # Отправляем сообщение с упоминаниями, при необходимости в несколько частей
+            for chunk in split_message([f'Участники роли "{html.escape(role)}":', (fragments, mentions_text)]):
+                send_queue.send(update.effective_chat.id, chunk, HIGH, parse_mode=ParseMode.HTML)
         else:
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f'Нет участников с ролью "{role}".'
-            )
+            send_queue.send(update.effective_chat.id, f'Нет участников с ролью "{role}".', HIGH)
 
         return ConversationHandler.END
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
-def cancel(update: Update, context: CallbackContext):
-    update.message.reply_text('Операция отменена.')
+@instrument
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text('Операция отменена.')
 
     # Удаляем системные сообщения бота
-    try:
-        if 'message_to_delete' in context.user_data:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
     # Удаляем сообщение пользователя с командой
-    try:
-        if 'user_command_message_id' in context.user_data:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-    except:
-        pass
+    deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
 
     # Очищаем данные пользователя
     context.user_data.clear()
@@ -601,49 +1319,84 @@ def cancel(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 # Обработчик сообщений для замены @<роль> на упоминания участников роли
-def role_mention_handler(update: Update, context: CallbackContext):
+@instrument
+async def role_mention_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     text = message.text
 
-    # Ищем шаблон @<роль>, регистронезависимо
-    pattern = r'@(\w+)'
-    matches = re.findall(pattern, text)
-
-    if matches:
-        all_mentions = []
-        roles_processed = set()
-
-        for role in matches:
-            role_lower = role.lower()
-            if role_lower in roles_processed:
-                continue  # Избегаем повторной обработки той же роли
-            roles_processed.add(role_lower)
-
-            # Проверяем, существует ли такая роль
-            conn = sqlite3.connect('db/roles.db')
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT username FROM roles WHERE LOWER(role) = ?", (role_lower,))
-            users = c.fetchall()
-            conn.close()
-
-            if users:
-                mentions = [f'@{username_tuple[0]}' for username_tuple in users]
-                all_mentions.extend(mentions)
-
-        if all_mentions:
-            # Убираем дубликаты
-            unique_mentions = list(set(all_mentions))
-            mentions_text = ' '.join(unique_mentions)
-
-            # Отправляем новое сообщение с упоминаниями
-            update.message.reply_text(mentions_text, parse_mode=ParseMode.HTML)
+    # Большинство сообщений не содержат упоминаний вовсе
+    if not text or '@' not in text:
+        return
+
+    # Ищем все известные роли одним проходом, регистронезависимо
+    roles = role_index.find_roles(message.chat.id, text)
+
+    if roles:
+        # Роли, на которые недавно уже отвечали, повторно не упоминаем
+        now = time.monotonic()
+        fresh, recent = mention_cooldowns.split(message.chat.id, roles, now)
+        mentioned = []
+        texts = []
+
+        for role_lower in fresh:
+            fragments, role_text = role_index.mentions(message.chat.id, role_lower)
+
+            if fragments:
+                mentioned.append(role_lower)
+                texts.append((fragments, role_text))
+
+        if texts:
+            reply = mention_cooldowns.remember(message.chat.id, mentioned, now)
+            mention_replies.inc(result='full')
+
+            # Одна роль - готовая строка; для нескольких участники идут в порядке ролей в сообщении,
+            # каждый по одному разу
+            if len(texts) == 1:
+                fragments, mentions_text = texts[0]
+            else:
+                fragments = tuple(dict.fromkeys(fragment for fragments, _ in texts for fragment in fragments))
+                mentions_text = ' '.join(fragments)
+
+            # Отправляем новое сообщение с упоминаниями, при необходимости в несколько частей.
+            # Ответы идут в нижнюю очередь, а одинаковые ответы подряд в чате склеиваются
+            for index, chunk in enumerate(split_message([(fragments, mentions_text)])):
+                send_queue.send(
+                    message.chat.id,
+                    chunk,
+                    LOW,
+                    coalesce_key=(message.chat.id, index, mentions_text),
+                    on_sent=reply.sent if index == 0 else None,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=message.message_id,
+                    allow_sending_without_reply=True,
+                )
+        elif recent:
+            # Все роли уже упомянуты: один раз за окно ссылаемся на прошлый ответ,
+            # а пока он ждёт в очереди, новое упоминание просто склеивается с ним
+            earlier = [reply for reply in recent if reply.message_id is not None and not reply.referenced]
+            if earlier:
+                for reply in earlier:
+                    reply.referenced = True
+                mention_replies.inc(result='reference')
+                names = ' '.join(f'@{role}' for role in roles)
+                send_queue.send(
+                    message.chat.id,
+                    html.escape(f'Участники {names} упомянуты выше.'),
+                    LOW,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=earlier[-1].message_id,
+                    allow_sending_without_reply=True,
+                )
+            else:
+                mention_replies.inc(result='suppressed')
             # context.bot.send_message(
             #     chat_id=message.chat.id,
             #     text=mentions_text,
             #     parse_mode=ParseMode.HTML
             # )
 
-def removerole_start(update: Update, context: CallbackContext):
+@instrument
+async def removerole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
@@ -655,259 +1408,483 @@ def removerole_start(update: Update, context: CallbackContext):
 
     # Проверяем, является ли пользователь администратором
     try:
-        member = context.bot.get_chat_member(chat.id, user.id)
-        if member.status not in ['administrator', 'creator']:
-            update.message.reply_text('Только администратор может удалять роли.')
+        if not await admin_cache.is_admin(context.bot, chat.id, user.id):
+            await update.message.reply_text('Только администратор может удалять роли.')
             # Удаляем сообщение пользователя с командой
-            try:
-                context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-            except:
-                pass
+            deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
             return ConversationHandler.END
     except:
-        update.message.reply_text('Не удалось проверить ваши права. Попробуйте позже.')
+        await update.message.reply_text('Не удалось проверить ваши права. Попробуйте позже.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
     # Получаем список ролей из базы данных
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT role FROM roles")
-    results = c.fetchall()
-    conn.close()
-
-    if results:
-        keyboard = []
-        for role_tuple in results:
-            role = role_tuple[0]
-            keyboard.append([InlineKeyboardButton(role, callback_data=f'removerole_role:{role}')])
-        keyboard.append([InlineKeyboardButton('Отмена', callback_data='cancel')])
+    reply_markup = await role_keyboards.get(update.effective_chat.id, REMOVEROLE)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        sent_message = update.message.reply_text('Выберите роль для удаления:', reply_markup=reply_markup)
+    if reply_markup is not None:
+        sent_message = await update.message.reply_text('Выберите роль для удаления:', reply_markup=reply_markup)
         context.user_data['message_to_delete'] = sent_message.message_id
         return REMOVEROLE_CHOOSE_ROLE
     else:
-        update.message.reply_text('Пока нет доступных ролей для удаления.')
+        await update.message.reply_text('Пока нет доступных ролей для удаления.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-def removerole_choose_role(update: Update, context: CallbackContext):
+@instrument
+async def removerole_choose_role(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'cancel':
-        try:
-            query.message.delete()
-        except:
-            pass
+    if action == CANCEL:
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=query.message.chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(query.message.chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-    if data.startswith('removerole_role:'):
-        role = data.split(':', 1)[1]
+    if action == ROLE:
+        role = value
 
         # Удаляем роль из базы данных
-        conn = sqlite3.connect('db/roles.db')
-        c = conn.cursor()
-        c.execute("DELETE FROM roles WHERE role = ?", (role,))
-        conn.commit()
-        conn.close()
+        usernames = await store.remove_role(query.message.chat.id, role)
+        role_index.remove(query.message.chat.id, role, usernames)
 
-        query.edit_message_text(f'Роль "{role}" успешно удалена.')
+        await query.edit_message_text(f'Роль "{role}" успешно удалена.')
 
         # Удаляем сообщения пользователя с командой и системные сообщения
-        try:
-            if 'message_to_delete' in context.user_data:
-                context.bot.delete_message(chat_id=query.message.chat.id, message_id=context.user_data['message_to_delete'])
-        except:
-            pass
+        deletion_queue.delete(query.message.chat.id, context.user_data.get('message_to_delete'))
 
-        try:
-            context.bot.delete_message(chat_id=query.message.chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(query.message.chat.id, context.user_data.get('user_command_message_id'))
 
         return ConversationHandler.END
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
-def assignrole_start(update: Update, context: CallbackContext):
+@instrument
+async def assignrole_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Автоматическая отмена предыдущего диалога
     context.user_data.clear()
 
     # Сохраняем ID сообщения пользователя с командой
     context.user_data['user_command_message_id'] = update.message.message_id
 
-    conn = sqlite3.connect('db/roles.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT role FROM roles")
-    results = c.fetchall()
-    conn.close()
+    reply_markup = await role_keyboards.get(update.effective_chat.id, ASSIGNROLE)
 
-    if results:
-        keyboard = []
-        for role_tuple in results:
-            role = role_tuple[0]
-            keyboard.append([InlineKeyboardButton(role, callback_data=f'assignrole_role:{role}')])
-        keyboard.append([InlineKeyboardButton('Отмена', callback_data='cancel')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        sent_message = update.message.reply_text('Выберите роль, которую хотите назначить себе:', reply_markup=reply_markup)
+    if reply_markup is not None:
+        sent_message = await update.message.reply_text('Выберите роль, которую хотите назначить себе:', reply_markup=reply_markup)
         context.user_data['message_to_delete'] = sent_message.message_id
         return ASSIGNROLE_CHOOSE_ROLE
     else:
-        update.message.reply_text('Пока нет доступных ролей.')
+        await update.message.reply_text('Пока нет доступных ролей.')
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-def assignrole_choose_role(update: Update, context: CallbackContext):
+@instrument
+async def assignrole_choose_role(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'cancel':
-        try:
-            query.message.delete()
-        except:
-            pass
+    if action == CANCEL:
+        deletion_queue.delete(query.message.chat.id, query.message.message_id)
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
         return ConversationHandler.END
 
-    if data.startswith('assignrole_role:'):
-        role = data.split(':', 1)[1].lower()
+    if action == ROLE:
+        role = value.lower()
         context.user_data['assignrole'] = {'role': role}
 
         # Подтверждение назначения роли
         keyboard = [
-            [InlineKeyboardButton('Да', callback_data='assignrole_confirm_yes')],
-            [InlineKeyboardButton('Нет', callback_data='assignrole_confirm_no')],
+            [InlineKeyboardButton('Да', callback_data=encode_callback(CONFIRM, YES))],
+            [InlineKeyboardButton('Нет', callback_data=encode_callback(CONFIRM, NO))],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(f'Вы уверены, что хотите назначить себе роль "{role}"?', reply_markup=reply_markup)
+        await query.edit_message_text(f'Вы уверены, что хотите назначить себе роль "{role}"?', reply_markup=reply_markup)
         return ASSIGNROLE_CONFIRM
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
-def assignrole_confirm(update: Update, context: CallbackContext):
+@instrument
+async def assignrole_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, action, value):
     query = update.callback_query
-    query.answer()
-    data = query.data
+    await query.answer()
 
-    if data == 'assignrole_confirm_yes':
+    if action == YES:
         role = context.user_data['assignrole'].get('role')
         if not role:
-            query.edit_message_text('Произошла ошибка. Роль не найдена.')
+            await query.edit_message_text('Произошла ошибка. Роль не найдена.')
             return ConversationHandler.END
 
-        username = update.effective_user.username
-        if not username:
-            query.edit_message_text('Не удалось получить ваше имя пользователя.')
-            return ConversationHandler.END
+        # Роль можно назначить себе и без username: участник запоминается по user_id
+        user = update.effective_user
+        key = member_key(user.id, user.username)
 
-        conn = sqlite3.connect('db/roles.db')
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO roles (username, role) VALUES (?, ?)", (username.lower(), role))
-        conn.commit()
-        conn.close()
+        await store.add_member(update.effective_chat.id, role, key)
+        role_index.add(update.effective_chat.id, role, [key])
 
-        query.edit_message_text(f'Вы успешно назначили себе роль "{role}".')
+        await query.edit_message_text(f'Вы успешно назначили себе роль "{role}".')
 
         # Удаляем системные сообщения бота
-        try:
-            if 'message_to_delete' in context.user_data:
-                context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
 
         return ConversationHandler.END
 
-    elif data == 'assignrole_confirm_no':
-        query.edit_message_text('Операция назначение роли отменена.')
+    elif action == NO:
+        await query.edit_message_text('Операция назначение роли отменена.')
 
         # Удаляем системные сообщения бота
-        try:
-            if 'message_to_delete' in context.user_data:
-                context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['message_to_delete'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('message_to_delete'))
 
         # Удаляем сообщение пользователя с командой
-        try:
-            context.bot.delete_message(chat_id=update.effective_chat.id, message_id=context.user_data['user_command_message_id'])
-        except:
-            pass
+        deletion_queue.delete(update.effective_chat.id, context.user_data.get('user_command_message_id'))
 
         return ConversationHandler.END
     else:
-        query.message.reply_text('Неизвестная команда.')
+        await query.message.reply_text('Неизвестная команда.')
         return ConversationHandler.END
 
+# Обработчики нажатий на inline-кнопки по диалогам
+callback_router.register(ROLES, list_roles_page)
+callback_router.register(SETROLE, setrole_option_callback)
+callback_router.register(DELETEROLE, deleterole_role_callback)
+callback_router.register(TAGROLE, tagrole_choose_role)
+callback_router.register(REMOVEROLE, removerole_choose_role)
+callback_router.register(ASSIGNROLE, assignrole_choose_role)
+callback_router.register(CONFIRM, assignrole_confirm)
+
+live_conversations = Gauge(
+    'roledistributor_live_conversations',
+    'Незавершённые диалоги',
+    ('conversation',),
+)
+conversation_timeouts = Counter(
+    'roledistributor_conversation_timeouts_total',
+    'Диалоги, завершённые по тайм-ауту',
+    ('conversation',),
+)
+user_data_entries = Gauge(
+    'roledistributor_user_data_entries',
+    'Пользователи с сохранённым user_data',
+)
+swept_user_data = Counter(
+    'roledistributor_swept_user_data_total',
+    'Записи user_data, удалённые при чистке',
+)
+
+# Время последнего обновления от пользователя (time.monotonic)
+user_activity = {}
+
+def conversation_timeout(name):
+    timeout = float(os.getenv(f'CONVERSATION_TIMEOUT_{name.upper()}', CONVERSATION_TIMEOUT))
+    return timeout or None
+
+# Запоминаем активность пользователей для чистки их состояния
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user is not None:
+        user_activity[update.effective_user.id] = time.monotonic()
+        # Запоминаем user_id и актуальный username для участников ролей
+        user_directory.observe(update.effective_user)
+
+# Обработчик тайм-аута диалога: убираем оставшиеся подсказки бота и команду пользователя
+def timeout_handler(name):
+    async def on_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        conversation_timeouts.inc(conversation=name)
+        chat = update.effective_chat
+        if context.user_data is not None:
+            end_conversation(chat.id if chat is not None else None, context.user_data)
+    return TypeHandler(Update, on_timeout)
+
+# Убирает сообщения брошенного диалога и очищает данные пользователя
+def end_conversation(chat_id, user_data):
+    if chat_id is not None:
+        deletion_queue.delete(chat_id, user_data.get('message_to_delete'))
+        deletion_queue.delete(chat_id, user_data.get('user_command_message_id'))
+    user_data.clear()
+
+# Состояния диалогов ConversationHandler хранит в закрытом словаре (ключ -> состояние);
+# публичного способа перечислить или завершить их нет
+def conversation_states(handler: ConversationHandler):
+    return handler._conversations
+
+# Периодическая чистка: завершает диалоги, брошенные до перезапуска (их тайм-ауты не
+# восстанавливаются), удаляет user_data неактивных пользователей и ограничивает общее число записей
+async def sweep_state(context: ContextTypes.DEFAULT_TYPE):
+    application = context.application
+    now = time.monotonic()
+    busy_users = set()
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler):
+                continue
+            states = conversation_states(handler)
+            timeout = handler.conversation_timeout or USER_DATA_TTL
+            for key in list(states):
+                user_id = key[-1]
+                # Пользователь, не писавший с запуска, считается активным с этого момента
+                last_seen = user_activity.setdefault(user_id, now)
+                if now - last_seen > timeout:
+                    states.pop(key, None)
+                    conversation_timeouts.inc(conversation=handler.name)
+                    # Ключ диалога - (chat_id, user_id)
+                    user_data = application.user_data.get(user_id)
+                    if user_data is not None:
+                        end_conversation(key[0], user_data)
+                else:
+                    busy_users.add(user_id)
+
+    idle = []
+    for user_id in list(application.user_data):
+        if user_id in busy_users:
+            continue
+        last_seen = user_activity.setdefault(user_id, now)
+        if now - last_seen > USER_DATA_TTL:
+            application.drop_user_data(user_id)
+            swept_user_data.inc()
+        else:
+            idle.append((last_seen, user_id))
 
-def main():
+    # Если пользователей всё ещё слишком много, удаляем дольше всех молчавших
+    overflow = len(application.user_data) - MAX_USER_DATA
+    if overflow > 0:
+        for _, user_id in sorted(idle)[:overflow]:
+            application.drop_user_data(user_id)
+            swept_user_data.inc()
+
+    for user_id in [user_id for user_id, last_seen in user_activity.items() if now - last_seen > USER_DATA_TTL]:
+        if user_id not in application.user_data:
+            del user_activity[user_id]
+
+    # Имена нужны только недавно активным пользователям и участникам ролей без username
+    user_directory.retain(user_activity.keys() | role_index.member_user_ids())
+
+# Запуск фоновых задач после инициализации приложения
+async def post_init(application: Application):
     # Инициализируем базу данных
-    init_db()
+    await init_db()
+
+    # Загружаем пользователей, индекс ролей и настройки упоминаний в память
+    await user_directory.load()
+    await role_index.load()
+    await mention_cooldowns.load()
+
+    # Запускаем фоновое удаление служебных сообщений и очередь отправки
+    deletion_queue.start(application.bot)
+    send_queue.start(application.bot)
 
-    # Создаем объект Updater и передаем ему токен бота
-    updater = Updater(TOKEN, use_context=True)
+    # Периодическая чистка состояния пользователей
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(sweep_state, interval=STATE_SWEEP_INTERVAL, first=STATE_SWEEP_INTERVAL)
+    else:
+        logging.warning("JobQueue is not available, user state will not be swept")
+
+# Досылаем накопленное (не дольше SEND_DRAIN_TIMEOUT), пока соединение с Bot API ещё открыто
+async def post_stop(application: Application):
+    await send_queue.stop()
+    await deletion_queue.stop()
+    await user_directory.flush()
+    await store.close()
+
+# Режим webhook: обновления принимает встроенный HTTP-сервер и кладёт
+# в очередь приложения, а дальше они обрабатываются так же, как при polling
+async def run_webhook(application: Application):
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+
+    # Очередь приложения живёт в цикле событий, а HTTP-сервер работает в своём потоке
+    loop = asyncio.get_running_loop()
+    server = WebhookServer(
+        application.bot,
+        lambda update, data: loop.call_soon_threadsafe(application.update_queue.put_nowait, update),
+        application.update_queue.qsize,
+    )
+    server.start()
+
+    await set_webhook(application.bot)
+    await server.idle()
+
+    server.stop()
+    await application.stop()
+    await post_stop(application)
+    await application.shutdown()
+
+async def set_webhook(bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=WEBHOOK_SECRET,
+        )
+
+# Режим webhook с несколькими рабочими процессами: этот процесс только принимает
+# обновления и раскладывает их по процессам по chat_id, каждый процесс - полноценный бот
+def run_webhook_workers(worker_count):
+    # Схему обновляем заранее, чтобы процессы не мигрировали базу одновременно
+    schema_store = create_store()
+    schema_store.init_db()
+    schema_store.close()
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(worker_count)]
+    # Изменения пользователей от рабочих процессов, которые рассылаются остальным
+    events = context.Queue()
+
+    def start_worker(index):
+        worker = context.Process(target=run_worker, args=(queues[index], index, events), name=f'worker-{index}')
+        worker.start()
+        return worker
+
+    workers = [start_worker(index) for index in range(worker_count)]
+
+    partitioner = UpdatePartitioner(queues)
+    relay = threading.Thread(target=partitioner.relay, args=(events,), name='worker-events', daemon=True)
+    relay.start()
+
+    asyncio.run(serve_partitioned(partitioner, workers, start_worker))
+
+    # Пустое значение - сигнал рабочему процессу завершиться
+    events.put(None)
+    relay.join()
+    for queue in queues:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+
+worker_restarts = Counter(
+    'roledistributor_worker_restarts_total',
+    'Перезапуски упавших рабочих процессов вебхука',
+)
+
+# Перезапускает упавшие рабочие процессы, иначе их чаты перестали бы обрабатываться
+async def supervise_workers(workers, start_worker):
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        for index, worker in enumerate(workers):
+            if not worker.is_alive():
+                logging.error(f"Worker {index} exited with code {worker.exitcode}, restarting")
+                worker_restarts.inc()
+                workers[index] = start_worker(index)
+
+async def serve_partitioned(partitioner, workers, start_worker):
+    server = WebhookServer(None, partitioner.submit, partitioner.queue_size)
+    server.start()
+    supervisor = asyncio.create_task(supervise_workers(workers, start_worker))
+
+    # Без WEBHOOK_URL вебхук не регистрируется, и Bot API не нужен вовсе
+    if WEBHOOK_URL:
+        async with Bot(TOKEN) as bot:
+            await set_webhook(bot)
+
+    await server.idle()
+    supervisor.cancel()
+    server.stop()
+
+# Рабочий процесс: обрабатывает обновления своих чатов из очереди
+def run_worker(updates, index, events):
+    # Останавливается по сигналу от принимающего процесса, а не по Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Метрики рабочих процессов - на следующих за METRICS_PORT портах
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + 1 + index)
+    user_directory.publish = lambda message: events.put((index, message))
+    # Состояние диалогов - в отдельном файле, чтобы чистка не трогала чужие диалоги
+    asyncio.run(process_updates(build_application(state_path=worker_state_path(index)), updates))
+
+async def process_updates(application: Application, updates):
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, updates.get)
+        if data is None:
+            break
+        # Изменения пользователей, записанные другим рабочим процессом
+        if isinstance(data, tuple):
+            user_directory.apply_remote(*data)
+            continue
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    await application.stop()
+    await post_stop(application)
+    await application.shutdown()
+
+# Собирает приложение со всеми обработчиками; builder можно передать заранее
+# настроенным, например с другим токеном или транспортом запросов
+def build_application(builder=None, state_path=STATE_DB_PATH):
+    if builder is None:
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            # Размер пула соединений как у ApplicationBuilder по умолчанию
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .get_updates_request(InstrumentedRequest())
+        )
+
+    # Обновления разных чатов обрабатываются параллельно; незавершённые диалоги
+    # и user_data переживают перезапуск
+    dp = (
+        builder
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .persistence(SQLitePersistence(state_path))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
 
-    # Получаем диспетчер для регистрации обработчиков
-    dp = updater.dispatcher
+    # Размеры состояния считаются при каждом сборе метрик
+    live_conversations.set_function(lambda: {
+        (handler.name,): len(conversation_states(handler))
+        for handlers in dp.handlers.values() for handler in handlers if isinstance(handler, ConversationHandler)
+    })
+    user_data_entries.set_function(lambda: {(): len(dp.user_data)})
+
+    # Активность пользователей для чистки их состояния
+    dp.add_handler(TypeHandler(Update, track_activity), group=-2)
+
+    # Изменения статусов участников для кэша администраторов
+    dp.add_handler(ChatMemberHandler(chat_member_updated, ChatMemberHandler.ANY_CHAT_MEMBER), group=-1)
 
     # Обработчики команд
     dp.add_handler(CommandHandler('start', start_command))
     dp.add_handler(CommandHandler('help', help_command))
     dp.add_handler(CommandHandler('roles', list_roles))
+    dp.add_handler(CommandHandler('mentioncooldown', mention_cooldown_command))
+    dp.add_handler(callback_router.handler(ROLES))
 
     # Обработчики для /setrole
     setrole_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('setrole', setrole_start)],
         states={
             SETROLE_CHOOSE_OPTION: [
-                CallbackQueryHandler(setrole_option_callback, pattern='^setrole_.*$'),
-                CallbackQueryHandler(setrole_option_callback, pattern='^(back|cancel)$'),
+                callback_router.handler(SETROLE),
                 CommandHandler('cancel', cancel),
             ],
             SETROLE_ENTER_ROLE_NAME: [
-                MessageHandler(Filters.text & ~Filters.command, setrole_new_role_name),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, setrole_new_role_name),
                 CommandHandler('cancel', cancel),
             ],
             SETROLE_SELECT_USER: [
-                MessageHandler(Filters.text & ~Filters.command, setrole_select_user),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, setrole_select_user),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('setrole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='setrole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('setrole'),
     )
     dp.add_handler(setrole_conv_handler)
 
@@ -916,12 +1893,16 @@ def main():
         entry_points=[CommandHandler('getrole', getrole_start)],
         states={
             GETROLE_ENTER_USERNAME: [
-                MessageHandler(Filters.text & ~Filters.command, getrole_enter_username),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, getrole_enter_username),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('getrole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='getrole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('getrole'),
     )
     dp.add_handler(getrole_conv_handler)
 
@@ -930,17 +1911,20 @@ def main():
         entry_points=[CommandHandler('deleterole', deleterole_start)],
         states={
             DELETEROLE_SELECT_USER: [
-                MessageHandler(Filters.text & ~Filters.command, deleterole_select_user),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, deleterole_select_user),
                 CommandHandler('cancel', cancel),
             ],
             DELETEROLE_SELECT_ROLE: [
-                CallbackQueryHandler(deleterole_role_callback, pattern='^deleterole_role:.*$'),
-                CallbackQueryHandler(deleterole_role_callback, pattern='^(back|cancel)$'),
+                callback_router.handler(DELETEROLE),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('deleterole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='deleterole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('deleterole'),
     )
     dp.add_handler(deleterole_conv_handler)
 
@@ -949,13 +1933,16 @@ def main():
         entry_points=[CommandHandler('tagrole', tagrole_start)],
         states={
             TAGROLE_CHOOSE_ROLE: [
-                CallbackQueryHandler(tagrole_choose_role, pattern='^tagrole_role:.*$'),
-                CallbackQueryHandler(tagrole_choose_role, pattern='^cancel$'),
+                callback_router.handler(TAGROLE),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('tagrole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='tagrole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('tagrole'),
     )
     dp.add_handler(tagrole_conv_handler)
 
@@ -964,41 +1951,61 @@ def main():
         entry_points=[CommandHandler('assignrole', assignrole_start)],
         states={
             ASSIGNROLE_CHOOSE_ROLE: [
-                CallbackQueryHandler(assignrole_choose_role, pattern='^assignrole_role:.*$'),
-                CallbackQueryHandler(assignrole_choose_role, pattern='^cancel$'),
+                callback_router.handler(ASSIGNROLE),
                 CommandHandler('cancel', cancel),
             ],
             ASSIGNROLE_CONFIRM: [
-                CallbackQueryHandler(assignrole_confirm, pattern='^assignrole_confirm_.*$'),
+                callback_router.handler(CONFIRM),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('assignrole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='assignrole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('assignrole'),
     )
     dp.add_handler(assignrole_conv_handler)
 
     # Обработчик сообщений для замены @<роль> на упоминания участников роли
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, role_mention_handler), group=1)
+    dp.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, role_mention_handler), group=1)
 
     # Обработчики для /removerole
     removerole_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('removerole', removerole_start)],
         states={
             REMOVEROLE_CHOOSE_ROLE: [
-                CallbackQueryHandler(removerole_choose_role, pattern='^removerole_role:.*$'),
-                CallbackQueryHandler(removerole_choose_role, pattern='^cancel$'),
+                callback_router.handler(REMOVEROLE),
                 CommandHandler('cancel', cancel),
             ],
+            ConversationHandler.TIMEOUT: [timeout_handler('removerole')],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
+        name='removerole',
+        persistent=True,
+        conversation_timeout=conversation_timeout('removerole'),
     )
     dp.add_handler(removerole_conv_handler)
 
-    # Запускаем бота
-    updater.start_polling()
-    updater.idle()
+    return dp
+
+def main():
+    # Публичный вебхук без секрета принял бы поддельные обновления от кого угодно
+    if BOT_MODE == 'webhook' and WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL is set without WEBHOOK_SECRET, refusing to register a public webhook")
+
+    # Метрики этого процесса на METRICS_PORT
+    start_http_server()
+
+    # Запускаем бота; обновления chat_member приходят, только если их запросить явно
+    if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1:
+        run_webhook_workers(WEBHOOK_WORKERS)
+    elif BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(build_application()))
+    else:
+        build_application().run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,231 @@
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, TelegramError
+
+from metrics import Counter
+
+# Общий лимит бота на исходящие сообщения в секунду
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '25'))
+# Лимит сообщений в секунду в одном чате и допустимый всплеск
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+# В течение скольких секунд одинаковые ответы на упоминания в чате не повторяются
+SEND_COALESCE_WINDOW = float(os.getenv('SEND_COALESCE_WINDOW', '10'))
+# Сколько сообщений может ждать в одной очереди, лишние отбрасываются
+SEND_QUEUE_LIMIT = int(os.getenv('SEND_QUEUE_LIMIT', '1000'))
+# Сколько секунд при остановке досылать очередь, прежде чем отбросить остаток
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '5'))
+
+# Очереди приоритетов: ответы на команды идут раньше ответов на упоминания
+HIGH, LOW = 0, 1
+LANE_NAMES = ('high', 'low')
+
+sent_messages = Counter(
+    'roledistributor_sent_messages_total',
+    'Сообщения, отправленные через очередь',
+    ('lane',),
+)
+send_failures = Counter(
+    'roledistributor_send_failures_total',
+    'Неудачные попытки отправки сообщений',
+    ('reason',),
+)
+coalesced_messages = Counter(
+    'roledistributor_coalesced_messages_total',
+    'Повторные ответы, не отправленные из-за окна склейки',
+)
+dropped_messages = Counter(
+    'roledistributor_dropped_messages_total',
+    'Сообщения, отброшенные из-за переполнения очереди',
+    ('lane',),
+)
+
+
+# Классическое ведро токенов: rate токенов в секунду, не больше capacity
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько секунд ждать до появления токена (0 - токен есть)
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id, lane, kwargs, on_sent=None):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.kwargs = kwargs
+        # Вызывается с отправленным сообщением (telegram.Message)
+        self.on_sent = on_sent
+
+
+# Планировщик исходящих сообщений.
+# Сообщения ставятся в одну из двух очередей и отправляются фоновой задачей,
+# когда есть токены и в общем ведре, и в ведре чата. В каждый чат одновременно
+# отправляется не больше одного сообщения, чтобы части длинного ответа не перемешались.
+# Если Telegram отвечает RetryAfter, сообщение возвращается в начало очереди, а чат ждёт retry_after секунд.
+class SendQueue:
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, coalesce_window=SEND_COALESCE_WINDOW,
+                 queue_limit=SEND_QUEUE_LIMIT, drain_timeout=SEND_DRAIN_TIMEOUT):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce_window = coalesce_window
+        self.queue_limit = queue_limit
+        self.drain_timeout = drain_timeout
+        self._lanes = (deque(), deque())
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # chat_id -> время (monotonic), раньше которого в чат не пишем
+        self._not_before = {}
+        # ключ склейки -> время, до которого такой же ответ не отправляется
+        self._recent = {}
+        # Чаты, в которые сейчас идёт отправка, и сами задачи отправки
+        self._in_flight = set()
+        self._sending = set()
+        self._wakeup = None
+        self._bot = None
+        self._task = None
+
+    # Запускает фоновую задачу; вызывается из работающего цикла событий
+    def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    # Досылает очередь с соблюдением лимитов и RetryAfter, но не дольше drain_timeout секунд,
+    # затем останавливает задачу; что не успело уйти, отбрасывается
+    async def stop(self):
+        if self._task is not None:
+            deadline = time.monotonic() + self.drain_timeout
+            while self.pending_count() or self._sending:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                await asyncio.sleep(min(left, 0.05))
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending)
+        left = self.pending_count()
+        if left:
+            logging.warning(f"Send queue stopped with {left} messages not sent")
+
+    # Ставит сообщение в очередь. Если задан coalesce_key и такой же ответ
+    # уже отправлялся в последние coalesce_window секунд, сообщение пропускается.
+    # on_sent получает отправленное сообщение, например чтобы потом ответить на него.
+    # Возвращает True, если сообщение поставлено в очередь.
+    def send(self, chat_id, text, lane=HIGH, coalesce_key=None, on_sent=None, **kwargs):
+        now = time.monotonic()
+        if coalesce_key is not None:
+            if self._recent.get(coalesce_key, 0) > now:
+                coalesced_messages.inc()
+                return False
+            if len(self._recent) > self.queue_limit:
+                self._recent = {k: t for k, t in self._recent.items() if t > now}
+            self._recent[coalesce_key] = now + self.coalesce_window
+
+        queue = self._lanes[lane]
+        if len(queue) >= self.queue_limit:
+            dropped_messages.inc(lane=LANE_NAMES[lane])
+            return False
+
+        kwargs['text'] = text
+        queue.append(OutgoingMessage(chat_id, lane, kwargs, on_sent))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def pending_count(self):
+        return sum(len(queue) for queue in self._lanes)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Выбирает первое сообщение, которое можно отправить прямо сейчас.
+    # Возвращает (сообщение или None, сколько ждать до следующей проверки)
+    def _next(self, now):
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for queue in self._lanes:
+            # Чаты, которые в этом проходе уже пропущены, чтобы сохранить порядок внутри чата
+            blocked = set(self._in_flight)
+            for index, message in enumerate(queue):
+                if message.chat_id in blocked:
+                    continue
+                delay = max(
+                    self._not_before.get(message.chat_id, 0) - now,
+                    self._chat_bucket(message.chat_id).wait_time(now),
+                )
+                if delay <= 0:
+                    del queue[index]
+                    self._global.take()
+                    self._chat_bucket(message.chat_id).take()
+                    return message, None
+                blocked.add(message.chat_id)
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            message, wait = self._next(time.monotonic())
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._in_flight.add(message.chat_id)
+            task = asyncio.create_task(self._send(message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, message):
+        try:
+            sent = await self._bot.send_message(chat_id=message.chat_id, **message.kwargs)
+            sent_messages.inc(lane=LANE_NAMES[message.lane])
+            if message.on_sent is not None:
+                message.on_sent(sent)
+        except RetryAfter as e:
+            send_failures.inc(reason='RetryAfter')
+            self._lanes[message.lane].appendleft(message)
+            self._not_before[message.chat_id] = time.monotonic() + e.retry_after
+        except TelegramError as e:
+            send_failures.inc(reason=type(e).__name__)
+            logging.warning(f"Could not send message to chat {message.chat_id}: {e}")
+        except Exception:
+            send_failures.inc(reason='error')
+            logging.exception(f"Error sending message to chat {message.chat_id}")
+        finally:
+            self._in_flight.discard(message.chat_id)
+            self._wakeup.set()
@@ -0,0 +1,12 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# Модули бота открывают базы по путям из окружения при импорте; тесты не должны трогать db/.
+# Процессы, запущенные тестами через spawn, импортируют пакет заново и наследуют окружение родителя
+if 'ROLEDISTRIBUTOR_TEST_DIR' not in os.environ:
+    os.environ['ROLEDISTRIBUTOR_TEST_DIR'] = tempfile.mkdtemp(prefix='roledistributor-tests-')
+    atexit.register(shutil.rmtree, os.environ['ROLEDISTRIBUTOR_TEST_DIR'], ignore_errors=True)
+    os.environ['ROLES_DB_URL'] = os.path.join(os.environ['ROLEDISTRIBUTOR_TEST_DIR'], 'roles.db')
+    os.environ['STATE_DB_PATH'] = os.path.join(os.environ['ROLEDISTRIBUTOR_TEST_DIR'], 'state.db')
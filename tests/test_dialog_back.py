@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+from telegram import Update
+from telegram.ext import Application
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+from fake_bot_api import ADMIN_ID, FakeBotAPI, UpdateFactory
+
+import roledistributor
+
+
+# Поддельный Bot API, который запоминает параметры отправленных сообщений
+class RecordingBotAPI(FakeBotAPI):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def _result(self, api_method, params):
+        if api_method == 'sendMessage':
+            self.sent.append(params)
+        return super()._result(api_method, params)
+
+
+class DialogBackTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = RecordingBotAPI()
+        self.application = roledistributor.build_application(
+            Application.builder().token('1:test').request(self.api).get_updates_request(FakeBotAPI())
+        )
+        self.errors = []
+
+        async def on_error(update, context):
+            self.errors.append(context.error)
+        self.application.add_error_handler(on_error)
+
+        await self.application.initialize()
+        self.addAsyncCleanup(self.application.shutdown)
+        await roledistributor.init_db()
+        await roledistributor.store.add_members(-10, 'dev', ['alice'])
+        await roledistributor.store.add_members(-11, 'dev', ['alice'])
+        await roledistributor.role_index.load()
+        self.factory = UpdateFactory()
+
+    async def process(self, data):
+        await self.application.process_update(Update.de_json(data, self.application.bot))
+
+    def sent_texts(self):
+        return [params['text'] for params in self.api.sent]
+
+    async def test_setrole_back_returns_to_options(self):
+        await self.process(self.factory.message(-10, ADMIN_ID, '/setrole'))
+        await self.process(self.factory.callback(-10, ADMIN_ID, 'sr:e:'))
+        await self.process(self.factory.callback(-10, ADMIN_ID, 'sr:b:'))
+
+        self.assertEqual(self.errors, [])
+        self.assertEqual(self.sent_texts(), ['Выберите опцию:', 'Выберите опцию:'])
+        # Кнопки снова работают: диалог вернулся к выбору опции
+        await self.process(self.factory.callback(-10, ADMIN_ID, 'sr:n:'))
+        self.assertEqual(self.errors, [])
+        self.assertEqual(self.api.calls['editMessageText'], 2)
+
+    async def test_deleterole_back_asks_for_users_again(self):
+        await self.process(self.factory.message(-11, ADMIN_ID, '/deleterole'))
+        await self.process(self.factory.message(-11, ADMIN_ID, '@alice'))
+        await self.process(self.factory.callback(-11, ADMIN_ID, 'dr:b:'))
+
+        self.assertEqual(self.errors, [])
+        prompt = 'Пожалуйста, введите @username пользователей через пробел, у которых вы хотите удалить роль:'
+        self.assertEqual(self.sent_texts().count(prompt), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
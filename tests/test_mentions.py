@@ -0,0 +1,46 @@
+import unittest
+
+from telegram import User
+
+import roledistributor
+
+
+class MemberNameTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        roledistributor.role_index.add(-20, 'dev', ['alice', '#42'])
+        self.addCleanup(roledistributor.role_index.remove, -20, 'dev', ['alice', '#42'])
+        self.directory = roledistributor.UserDirectory(flush_delay=3600)
+        directory = roledistributor.user_directory
+        roledistributor.user_directory = self.directory
+        self.addCleanup(setattr, roledistributor, 'user_directory', directory)
+
+    def tearDown(self):
+        if self.directory._flush_task is not None:
+            self.directory._flush_task.cancel()
+
+    async def test_first_sighting_replaces_fallback_label(self):
+        _, before = roledistributor.role_index.mentions(-20, 'dev')
+        self.assertIn('>42</a>', before)
+
+        self.directory.observe(User(42, 'Bob Smith', False))
+
+        _, after = roledistributor.role_index.mentions(-20, 'dev')
+        self.assertTrue(after.startswith('@alice '))
+        self.assertIn('>Bob\u00a0Smith</a>', after)
+
+    async def test_name_change_resets_only_roles_of_that_member(self):
+        roledistributor.role_index.add(-21, 'qa', ['carol'])
+        self.addCleanup(roledistributor.role_index.remove, -21, 'qa', ['carol'])
+        self.directory.observe(User(42, 'Bob', False))
+        roledistributor.role_index.mentions(-20, 'dev')
+        qa = roledistributor.role_index.mentions(-21, 'qa')
+
+        self.directory.observe(User(42, 'Robert', False))
+
+        self.assertIn('>Robert</a>', roledistributor.role_index.mentions(-20, 'dev')[1])
+        self.assertIs(roledistributor.role_index.mentions(-21, 'qa'), qa)
+        self.assertEqual(roledistributor.role_index.member_user_ids() & {42}, {42})
+
+
+if __name__ == '__main__':
+    unittest.main()
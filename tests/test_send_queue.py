@@ -0,0 +1,68 @@
+import time
+import unittest
+
+from telegram.error import RetryAfter
+
+from send_queue import SendQueue, HIGH, LOW
+
+
+# Bot API, который запоминает отправленные сообщения и может один раз ответить RetryAfter
+class FakeBot:
+    def __init__(self, retry_after=None):
+        self.sent = []
+        self.retry_after = retry_after
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.retry_after is not None:
+            retry_after, self.retry_after = self.retry_after, None
+            raise RetryAfter(retry_after)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+class SendQueueStopTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stop_delivers_queued_messages(self):
+        bot = FakeBot()
+        queue = SendQueue(global_rate=100, chat_rate=20, chat_burst=1, drain_timeout=5)
+        queue.start(bot)
+        for i in range(5):
+            queue.send(-1, f'reply {i}', LOW)
+        queue.send(-2, 'command', HIGH)
+
+        await queue.stop()
+
+        self.assertEqual(queue.pending_count(), 0)
+        self.assertEqual([text for chat_id, text, _ in bot.sent if chat_id == -1], [f'reply {i}' for i in range(5)])
+        self.assertIn((-2, 'command'), [(chat_id, text) for chat_id, text, _ in bot.sent])
+        # Лимит чата соблюдается и при остановке
+        times = [at for chat_id, _, at in bot.sent if chat_id == -1]
+        self.assertGreaterEqual(times[-1] - times[0], 4 / 20 * 0.9)
+
+    async def test_stop_waits_for_retry_after(self):
+        bot = FakeBot(retry_after=1)
+        queue = SendQueue(drain_timeout=5)
+        queue.start(bot)
+        queue.send(-1, 'mention', LOW)
+
+        await queue.stop()
+
+        self.assertEqual([text for _, text, _ in bot.sent], ['mention'])
+
+    async def test_stop_gives_up_after_drain_timeout(self):
+        bot = FakeBot()
+        queue = SendQueue(global_rate=100, chat_rate=1, chat_burst=1, drain_timeout=0.3)
+        queue.start(bot)
+        for i in range(10):
+            queue.send(-1, f'reply {i}', LOW)
+
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            await queue.stop()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(bot.sent), 1)
+        self.assertEqual(queue.pending_count(), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
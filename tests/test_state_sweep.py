@@ -0,0 +1,50 @@
+import time
+import types
+import unittest
+
+from telegram import User
+from telegram.ext import Application, ConversationHandler
+
+import roledistributor
+
+
+class LiveConversationsTest(unittest.TestCase):
+    def test_gauge_is_computed_at_scrape_time(self):
+        application = roledistributor.build_application(Application.builder().token('1:test'))
+        handler = next(handler for handlers in application.handlers.values() for handler in handlers
+                       if isinstance(handler, ConversationHandler) and handler.name == 'setrole')
+        self.assertEqual(roledistributor.live_conversations.collect()[('setrole',)], 0)
+
+        roledistributor.conversation_states(handler)[(-1, 5)] = 0
+        self.addCleanup(roledistributor.conversation_states(handler).clear)
+        self.assertEqual(roledistributor.live_conversations.collect()[('setrole',)], 1)
+
+
+class UserDirectoryTrimTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = roledistributor.UserDirectory(flush_delay=3600)
+        roledistributor.role_index.add(-1, 'dev', ['#7'])
+        self.addCleanup(roledistributor.role_index.remove, -1, 'dev', ['#7'])
+        self.addCleanup(roledistributor.user_activity.clear)
+
+    async def test_sweep_forgets_inactive_users_but_keeps_members(self):
+        for user_id, username in ((5, 'active'), (6, 'gone'), (7, None)):
+            self.directory.observe(User(user_id, f'Name{user_id}', False, username=username))
+        now = time.monotonic()
+        roledistributor.user_activity.update({5: now, 6: now - roledistributor.USER_DATA_TTL - 1})
+        application = types.SimpleNamespace(handlers={}, user_data={}, drop_user_data=None)
+        directory = roledistributor.user_directory
+        roledistributor.user_directory = self.directory
+        self.addCleanup(setattr, roledistributor, 'user_directory', directory)
+
+        await roledistributor.sweep_state(types.SimpleNamespace(application=application))
+
+        self.assertEqual(self.directory.name(5), 'Name5')
+        self.assertEqual(self.directory.name(6), '6')
+        # Участник роли без username недавно не писал, но его имя нужно для упоминаний
+        self.assertEqual(self.directory.name(7), 'Name7')
+        self.directory._flush_task.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
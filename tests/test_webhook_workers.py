@@ -0,0 +1,65 @@
+import asyncio
+import json
+import queue
+import unittest
+import urllib.error
+import urllib.request
+
+import webhook_server
+from webhook_server import UpdatePartitioner, WebhookServer
+
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': -1, 'type': 'group'}, 'text': 'hi'}}
+
+
+class FullQueueTest(unittest.TestCase):
+    def test_full_worker_queue_answers_503(self):
+        full = queue.Queue(1)
+        full.put('stuck')
+        partitioner = UpdatePartitioner([full])
+        timeout = webhook_server.WORKER_QUEUE_TIMEOUT
+        webhook_server.WORKER_QUEUE_TIMEOUT = 0.1
+        self.addCleanup(setattr, webhook_server, 'WORKER_QUEUE_TIMEOUT', timeout)
+
+        server = WebhookServer(None, partitioner.submit, partitioner.queue_size, listen='127.0.0.1', port=0)
+        server.start()
+        self.addCleanup(server.stop)
+        host, port = server.server_address[:2]
+        request = urllib.request.Request(f'http://{host}:{port}{server.path}', data=json.dumps(UPDATE).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with self.assertLogs(level='WARNING'), self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request, timeout=5)
+        self.assertEqual(error.exception.code, 503)
+
+
+# Процесс, который либо жив, либо завершился с кодом
+class FakeWorker:
+    def __init__(self, alive):
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+class SuperviseWorkersTest(unittest.IsolatedAsyncioTestCase):
+    async def test_dead_worker_is_restarted(self):
+        import roledistributor
+        workers = [FakeWorker(True), FakeWorker(False)]
+        started = []
+
+        def start_worker(index):
+            started.append(index)
+            return FakeWorker(True)
+
+        supervisor = asyncio.create_task(roledistributor.supervise_workers(workers, start_worker))
+        with self.assertLogs(level='ERROR'):
+            await asyncio.sleep(roledistributor.WORKER_CHECK_INTERVAL * 1.5)
+        supervisor.cancel()
+
+        self.assertEqual(started, [1])
+        self.assertTrue(all(worker.is_alive() for worker in workers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import asyncio
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+from role_store import RoleStore
+from webhook_server import UpdatePartitioner
+
+
+# Рабочие процессы запускаются через spawn, как в run_webhook_workers, и получают базу через ROLES_DB_URL
+async def load_worker():
+    import roledistributor as bot
+    await bot.init_db()
+    await bot.user_directory.load()
+    await bot.role_index.load()
+    return bot
+
+
+def rename_user(index, events, results):
+    async def main():
+        from telegram import User
+        bot = await load_worker()
+        bot.user_directory.publish = lambda message: events.put((index, message))
+        bot.user_directory.observe(User(5, 'Ann', False, username='New'))
+        await bot.user_directory.flush()
+        results.put(bot.role_index.mentions(-2, 'dev')[1])
+        await bot.store.close()
+    asyncio.run(main())
+
+
+def receive_changes(updates, results):
+    async def main():
+        bot = await load_worker()
+        results.put('ready')
+        bot.user_directory.apply_remote(*updates.get(timeout=30))
+        results.put(bot.role_index.mentions(-1, 'dev')[1])
+        await bot.store.close()
+    asyncio.run(main())
+
+
+class WorkerEventsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'roles.db')
+        store = RoleStore(self.db_path)
+        store.init_db()
+        store.upsert_users([(5, 'old', 'Ann')])
+        # Чат -1 принадлежит второму процессу, чат -2 - первому
+        store.add_member(-1, 'dev', 'old')
+        store.add_member(-2, 'dev', 'old')
+        store.close()
+        self.addCleanup(os.environ.__setitem__, 'ROLES_DB_URL', os.environ['ROLES_DB_URL'])
+        os.environ['ROLES_DB_URL'] = self.db_path
+
+    def test_username_change_reaches_other_worker(self):
+        context = multiprocessing.get_context('spawn')
+        queues = [context.Queue(), context.Queue()]
+        events = context.Queue()
+        results = [context.Queue(), context.Queue()]
+        partitioner = UpdatePartitioner(queues)
+        relay = threading.Thread(target=partitioner.relay, args=(events,), daemon=True)
+        relay.start()
+
+        receiver = context.Process(target=receive_changes, args=(queues[1], results[1]))
+        receiver.start()
+        # Второй процесс должен загрузить индекс до того, как первый перепишет базу
+        self.assertEqual(results[1].get(timeout=60), 'ready')
+        renamer = context.Process(target=rename_user, args=(0, events, results[0]))
+        renamer.start()
+
+        self.assertEqual(results[0].get(timeout=60), '@new')
+        self.assertEqual(results[1].get(timeout=60), '@new')
+        renamer.join(timeout=30)
+        receiver.join(timeout=30)
+        events.put(None)
+        relay.join(timeout=5)
+        self.assertTrue(queues[0].empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
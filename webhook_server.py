@@ -0,0 +1,189 @@
+import os
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full
+
+from telegram import Update
+
+from metrics import Counter
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Адрес и порт встроенного HTTP-сервера
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Путь, на который Telegram (или обратный прокси) присылает обновления
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Внешний адрес вебхука; если не задан, вебхук не регистрируется в Telegram
+# (например, при локальной нагрузке через поддельного отправителя)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Число рабочих процессов; обновления распределяются между ними по chat_id
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+# Сколько обновлений может ждать в очереди одного рабочего процесса
+WORKER_QUEUE_SIZE = 1000
+# Сколько секунд ждать места в очереди рабочего процесса, прежде чем ответить 503
+WORKER_QUEUE_TIMEOUT = float(os.getenv('WORKER_QUEUE_TIMEOUT', '5'))
+# Как часто проверять, что рабочие процессы живы, секунды
+WORKER_CHECK_INTERVAL = 1
+HEALTH_PATH = '/healthz'
+# Обновления Telegram не бывают больше нескольких килобайт
+MAX_BODY_SIZE = 1024 * 1024
+
+webhook_requests = Counter(
+    'roledistributor_webhook_requests_total',
+    'Запросы к встроенному HTTP-серверу',
+    ('status',),
+)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self._path() != HEALTH_PATH:
+            self._reply(404)
+            return
+        body = {'status': 'ok', 'update_queue': self.server.webhook.queue_size()}
+        self._reply(200, json.dumps(body))
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self._path() != webhook.path:
+            self._reply(404)
+            return
+
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if webhook.secret and not hmac.compare_digest(secret, webhook.secret):
+            self._reply(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > MAX_BODY_SIZE:
+            self._reply(400)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, webhook.bot)
+        except Exception:
+            logging.warning("Could not parse webhook update", exc_info=True)
+            self._reply(400)
+            return
+
+        # Отвечаем сразу: обработкой займётся приложение или рабочий процесс.
+        # Если очередь процесса так и не освободилась, Telegram повторит доставку позже
+        try:
+            webhook.submit(update, data)
+        except Full:
+            logging.warning("Worker queue is full, rejecting update")
+            self._reply(503)
+            return
+        self._reply(200)
+
+    # Путь без строки запроса; прокси может добавлять её при проксировании
+    def _path(self):
+        return self.path.split('?', 1)[0]
+
+    def _reply(self, status, body=''):
+        webhook_requests.inc(status=status)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if body else 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+# Встроенный HTTP-сервер для режима webhook.
+# Работает в отдельном потоке и передаёт каждое обновление в submit(update, data):
+# в update_queue приложения или в очередь рабочего процесса.
+class WebhookServer:
+    def __init__(self, bot, submit, queue_size, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.bot = bot
+        self.submit = submit
+        self.queue_size = queue_size
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return self._httpd.server_address
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), WebhookRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='webhook-server', daemon=True)
+        self._thread.start()
+        logging.info(f"Webhook listening on {self.listen}:{self.port}{self.path}")
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+    # Ждёт SIGINT/SIGTERM, как Application.run_polling()
+    async def idle(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(sig, stop_event.set)
+        await stop_event.wait()
+
+
+# Чат, по которому обновление закрепляется за рабочим процессом;
+# для обновлений без чата - пользователь
+def partition_key(update):
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+# Раскладывает обновления по очередям рабочих процессов. Все обновления одного чата
+# попадают в один процесс, поэтому его индекс ролей в памяти и диалоги остаются согласованными.
+class UpdatePartitioner:
+    def __init__(self, queues):
+        self.queues = queues
+
+    def submit(self, update, data):
+        self.queues[partition_key(update) % len(self.queues)].put(data, timeout=WORKER_QUEUE_TIMEOUT)
+
+    # Пересылает сообщения рабочих процессов (номер отправителя, сообщение) всем остальным,
+    # пока не получит None
+    def relay(self, events):
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            source, message = event
+            for index, queue in enumerate(self.queues):
+                if index == source:
+                    continue
+                try:
+                    queue.put(message, timeout=WORKER_QUEUE_TIMEOUT)
+                except Full:
+                    # Процесс не разбирает очередь; после перезапуска он всё равно загрузит пользователей из базы
+                    logging.warning(f"Worker {index} queue is full, user changes from worker {source} dropped")
+
+    def queue_size(self):
+        return sum(queue.qsize() for queue in self.queues)